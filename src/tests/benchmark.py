@@ -0,0 +1,315 @@
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import resource
+import subprocess
+import argparse
+
+SRC_FOLDER = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Stand-in for the yt-dlp binary. It answers metadata and download calls offline and
+# writes a synthetic media file, so the pipeline runs without network access.
+FAKE_YT_DLP = r'''#!/usr/bin/env python3
+import os, sys, json
+args = sys.argv[1:]
+size = int(os.environ.get("BENCHMARK_VIDEO_SIZE", "65536"))
+urls = [arg for arg in args if arg.startswith("http")]
+
+def video_id(url):
+    return url.rsplit("=", 1)[-1]
+
+def info(url):
+    return {"id": video_id(url), "title": "Video " + video_id(url), "duration": 60, "original_url": url,
+            "webpage_url": url, "formats": [{"format_id": "18", "ext": "mp4", "height": 360, "filesize": size}]}
+
+if "--flat-playlist" in args:
+    for i in range(int(os.environ.get("BENCHMARK_CHANNEL_SIZE", "100"))):
+        print(f"chan{i:08d}")
+elif "--dump-json" in args:
+    for url in urls:
+        print(json.dumps(info(url)))
+else:
+    template = args[args.index("-o") + 1]
+    path = template.replace("%(title)s", info(urls[0])["title"]).replace("%(id)s", video_id(urls[0])).replace("%(ext)s", "mp4")
+    if "--progress-template" in args:
+        prefix = args[args.index("--progress-template") + 1].split(":", 1)[1].split("%", 1)[0]
+        print(prefix + json.dumps({"status": "finished", "downloaded_bytes": size, "total_bytes": size}))
+    with open(path, "wb") as file:
+        file.write(b"\0" * size)
+    if "--print-to-file" in args:
+        with open(args[args.index("--print-to-file") + 2], "a") as file:
+            file.write(path + "\n")
+'''
+
+# Stand-in for the yt_dlp Python package, used with --engine api
+FAKE_YT_DLP_PACKAGE = r'''import os
+
+class utils:
+    class DownloadError(Exception):
+        pass
+
+class YoutubeDL:
+    def __init__(self, params=None):
+        self.params = params or {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def sanitize_info(self, info):
+        return info
+
+    def extract_info(self, url, download=True, process=True):
+        size = int(os.environ.get("BENCHMARK_VIDEO_SIZE", "65536"))
+        video_id = url.rsplit("=", 1)[-1]
+        info = {"id": video_id, "title": "Video " + video_id, "duration": 60, "webpage_url": url,
+                "formats": [{"format_id": "18", "ext": "mp4", "height": 360, "filesize": size}]}
+        if download:
+            path = self.params["outtmpl"].replace("%(title)s", info["title"]).replace("%(id)s", video_id).replace("%(ext)s", "mp4")
+            for hook in self.params.get("progress_hooks", []):
+                hook({"status": "finished", "downloaded_bytes": size, "total_bytes": size})
+            with open(path, "wb") as file:
+                file.write(b"\0" * size)
+            for hook in self.params.get("post_hooks", []):
+                hook(path)
+        return info
+'''
+
+def write_fakes(folder):
+    """
+    Write the fake yt-dlp executable and yt_dlp package into a folder.
+
+    Parameters:
+    - folder: The folder to write them into. It is put first on PATH and PYTHONPATH.
+    """
+    bin_folder = os.path.join(folder, "bin")
+    package_folder = os.path.join(folder, "python", "yt_dlp")
+    os.makedirs(bin_folder, exist_ok=True)
+    os.makedirs(package_folder, exist_ok=True)
+    executable = os.path.join(bin_folder, "yt-dlp")
+    with open(executable, "w") as file:
+        file.write(FAKE_YT_DLP.replace("#!/usr/bin/env python3", f"#!{sys.executable}", 1))
+    os.chmod(executable, 0o755)
+    with open(os.path.join(package_folder, "__init__.py"), "w") as file:
+        file.write(FAKE_YT_DLP_PACKAGE)
+
+def write_download_list(data_folder, size):
+    """
+    Write a download list with synthetic video URLs.
+
+    Parameters:
+    - data_folder: The yt-downloader-py data folder.
+    - size: The number of URLs.
+
+    Returns:
+    - The path to the download list file.
+    """
+    download_list_path = os.path.join(data_folder, "download-list.txt")
+    with open(download_list_path, "w") as file:
+        for i in range(size):
+            file.write(f"https://www.youtube.com/watch?v=vid{i:08d}\n")
+    return download_list_path
+
+def read_syscalls():
+    """
+    Read the number of read and write syscalls made by this process so far.
+
+    Returns:
+    - The syscall count, or None where /proc/self/io is not available.
+    """
+    try:
+        with open("/proc/self/io", "r") as file:
+            fields = dict(line.split(": ") for line in file.read().splitlines())
+        return int(fields["syscr"]) + int(fields["syscw"])
+    except (OSError, KeyError, ValueError):
+        return None
+
+def run_scenario(scenario, size, engine_name, jobs):
+    """
+    Run one scenario in this process and measure it. Called in a fresh child process per scenario,
+    so peak RSS is not carried over from earlier runs.
+
+    Parameters:
+    - scenario: One of validate, download, ledger, journal.
+    - size: The number of URLs.
+    - engine_name: "api" or "subprocess".
+    - jobs: The number of workers.
+
+    Returns:
+    - A dict with the measurements.
+    """
+    sys.path.insert(0, SRC_FOLDER)
+    import yt_downloader_py as downloader
+
+    data_folder = os.path.expanduser("~/yt-downloader-py-data")
+    download_folder = os.path.join(data_folder, "downloaded-yt-video")
+    os.makedirs(download_folder, exist_ok=True)
+    download_list_path = write_download_list(data_folder, size)
+
+    handler = downloader.DownloadListHandler(download_list_path)
+    ledger = downloader.DownloadLedger(os.path.join(data_folder, "download-ledger.sqlite3"))
+    cache = downloader.MetadataCache(os.path.join(data_folder, "metadata-cache.sqlite3"))
+    engine = downloader.get_engine(engine_name)
+
+    if scenario == "ledger":
+        # A library of `size` finished videos, then one skip decision per URL
+        for url in handler.get_urls():
+            video_id = downloader.extract_video_id(url)
+            path = os.path.join(download_folder, f"Video {video_id}_best.mp4")
+            open(path, "wb").close()
+            ledger.record(video_id, "best", "finalized", path, 0)
+
+    syscalls_before = read_syscalls()
+    started_at = time.perf_counter()
+
+    if scenario == "validate":
+        downloader.validate_download_list(handler, "best", jobs, ledger, cache, engine)
+    elif scenario == "download":
+        downloader.batch_download_videos("best", handler, jobs, ledger, engine)
+    elif scenario == "ledger":
+        downloader.validate_download_list(handler, "best", jobs, ledger, cache, engine)
+    elif scenario == "journal":
+        for url in list(handler.get_urls()):
+            handler.mark_done(url)
+        handler.compact()
+
+    wall_time = time.perf_counter() - started_at
+    syscalls_after = read_syscalls()
+    ledger.close()
+    cache.close()
+
+    self_usage = resource.getrusage(resource.RUSAGE_SELF)
+    children_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return {
+        "scenario": scenario,
+        "size": size,
+        "engine": engine_name,
+        "wall_time": wall_time,
+        "syscalls": None if syscalls_before is None else syscalls_after - syscalls_before,
+        "context_switches": self_usage.ru_nvcsw + self_usage.ru_nivcsw,
+        # ru_maxrss is in KiB on Linux
+        "peak_rss_mib": self_usage.ru_maxrss / 1024,
+        "children_peak_rss_mib": children_usage.ru_maxrss / 1024,
+    }
+
+def run_benchmarks(scenarios, sizes, engine_name, jobs, video_size):
+    """
+    Run every scenario at every size, each in its own child process and data folder.
+
+    Parameters:
+    - scenarios: The scenarios to run.
+    - sizes: The numbers of URLs to run each scenario with.
+    - engine_name: "api" or "subprocess".
+    - jobs: The number of workers.
+    - video_size: The size in bytes of each synthetic video.
+
+    Returns:
+    - A list of result dicts.
+    """
+    results = []
+    fakes_folder = tempfile.mkdtemp(prefix="yt-downloader-py-bench-")
+    try:
+        write_fakes(fakes_folder)
+        for scenario in scenarios:
+            for size in sizes:
+                home = tempfile.mkdtemp(prefix="home-", dir=fakes_folder)
+                env = dict(os.environ)
+                env["HOME"] = home
+                env["PATH"] = os.path.join(fakes_folder, "bin") + os.pathsep + env.get("PATH", "")
+                env["PYTHONPATH"] = os.path.join(fakes_folder, "python") + os.pathsep + env.get("PYTHONPATH", "")
+                env["BENCHMARK_VIDEO_SIZE"] = str(video_size)
+                command = [sys.executable, os.path.abspath(__file__), "--run-one", scenario, str(size), engine_name, str(jobs)]
+                result = subprocess.run(command, env=env, capture_output=True, text=True)
+                if result.returncode != 0:
+                    print(f"Scenario {scenario} with {size} URLs failed:\n{result.stderr}")
+                    continue
+                results.append(json.loads(result.stdout.strip().splitlines()[-1]))
+                shutil.rmtree(home, ignore_errors=True)
+    finally:
+        shutil.rmtree(fakes_folder, ignore_errors=True)
+    return results
+
+def print_results(results):
+    """
+    Print the results as a table.
+
+    Parameters:
+    - results: A list of result dicts.
+    """
+    print(f"{'scenario':<10} {'urls':>7} {'engine':<11} {'wall s':>9} {'syscalls':>10} {'ctx sw':>9} {'rss MiB':>8} {'child MiB':>10}")
+    for r in results:
+        syscalls = "-" if r["syscalls"] is None else r["syscalls"]
+        print(f"{r['scenario']:<10} {r['size']:>7} {r['engine']:<11} {r['wall_time']:>9.3f} {syscalls:>10} "
+              f"{r['context_switches']:>9} {r['peak_rss_mib']:>8.1f} {r['children_peak_rss_mib']:>10.1f}")
+
+def usage():
+    """
+    Display usage instructions and examples.
+    """
+    usage_text = """
+Usage: python benchmark.py [options]
+
+Options:
+  -h, --help            Show this help message and exit
+  --scenarios           Comma-separated scenarios to run (default: validate,download,ledger,journal)
+  --sizes               Comma-separated numbers of URLs (default: 10,1000,50000)
+  --engine              Engine to benchmark (choices: api, subprocess; default: api)
+  -j, --jobs            Number of workers (default: 4)
+  --video-size          Size in bytes of each synthetic video (default: 65536)
+  --json                Print the results as JSON instead of a table
+
+Examples:
+  1. Run every scenario in-process at 10, 1k and 50k URLs:
+     python benchmark.py
+
+  2. Measure process spawn cost with the fake yt-dlp binary:
+     python benchmark.py --engine subprocess --sizes 10,1000
+
+Description:
+  This script benchmarks the download pipeline without network access. A fake yt-dlp binary
+  (--engine subprocess) or a fake yt_dlp package (--engine api) serves synthetic videos.
+  Every run uses a throwaway home folder.
+  Scenarios:
+    validate  validate_download_list: metadata lookups for every URL
+    download  batch_download_videos: download, ledger update and journal for every URL
+    ledger    validate_download_list over a library where every URL is already downloaded
+    journal   marking every URL done in download-list.journal, then compacting the list
+  Each scenario reports wall time, read/write syscalls, context switches and peak RSS.
+
+Note:
+  The watchdog package is optional here; without it the download list is not monitored for changes.
+"""
+    print(usage_text)
+
+if __name__ == "__main__":
+    if len(sys.argv) == 6 and sys.argv[1] == "--run-one":
+        print(json.dumps(run_scenario(sys.argv[2], int(sys.argv[3]), sys.argv[4], int(sys.argv[5]))))
+        sys.exit(0)
+
+    parser = argparse.ArgumentParser(description="Benchmark the download pipeline offline.", add_help=False)
+    parser.add_argument("--scenarios", default="validate,download,ledger,journal", help="Comma-separated scenarios to run")
+    parser.add_argument("--sizes", default="10,1000,50000", help="Comma-separated numbers of URLs")
+    parser.add_argument("--engine", choices=["api", "subprocess"], default="api", help="Engine to benchmark")
+    parser.add_argument("-j", "--jobs", type=int, default=4, help="Number of workers")
+    parser.add_argument("--video-size", type=int, default=65536, help="Size in bytes of each synthetic video")
+    parser.add_argument("--json", action="store_true", help="Print the results as JSON instead of a table")
+    parser.add_argument("-h", "--help", action="store_true", help="Show this help message and exit")
+    args = parser.parse_args()
+
+    if args.help:
+        usage()
+        exit()
+
+    scenarios = [scenario for scenario in args.scenarios.split(",") if scenario]
+    sizes = [int(size) for size in args.sizes.split(",") if size]
+    results = run_benchmarks(scenarios, sizes, args.engine, args.jobs, args.video_size)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print_results(results)
@@ -23,37 +23,203 @@ install_and_import('tqdm')
 
 from tqdm import tqdm
 import argparse
+import json
+import sqlite3
 
-def get_video_urls(channel_url):
+SRC_FOLDER = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, SRC_FOLDER)
+# Shares the downloader's URL parsing, so both agree on which videos are already known
+from yt_downloader_py import extract_video_id
+
+try:
+    import fcntl
+except ImportError:
+    # Windows: appends are not coordinated with the downloader's compaction
+    fcntl = None
+
+def iter_video_ids_api(channel_url):
     """
-    Get all video URLs from a YouTube channel.
+    Yield video IDs from a YouTube channel as they are listed, using the yt_dlp Python package.
+    Only the channel's playlist pages are fetched, not the individual video pages.
 
     Parameters:
     - channel_url: The URL of the YouTube channel's videos page.
 
     Returns:
-    - A list of video URLs.
+    - A generator of video IDs, newest first.
+    """
+    import yt_dlp
+
+    params = {"quiet": True, "no_warnings": True, "ignoreerrors": True, "extract_flat": "in_playlist", "lazy_playlist": True}
+    with yt_dlp.YoutubeDL(params) as ydl:
+        info = ydl.extract_info(channel_url, download=False, process=False)
+        for entry in (info or {}).get("entries") or []:
+            if entry and entry.get("id"):
+                yield entry["id"]
+
+def iter_video_ids_subprocess(channel_url):
+    """
+    Yield video IDs from a YouTube channel as yt-dlp prints them.
+    Only the channel's playlist pages are fetched, not the individual video pages.
+
+    Parameters:
+    - channel_url: The URL of the YouTube channel's videos page.
+
+    Returns:
+    - A generator of video IDs, newest first.
+    """
+    command = ["yt-dlp", "--flat-playlist", "--print", "id", channel_url]
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, text=True)
+    try:
+        for line in process.stdout:
+            video_id = line.strip()
+            if video_id:
+                yield video_id
+        if process.wait() != 0:
+            raise RuntimeError(f"yt-dlp exited with code {process.returncode} while listing {channel_url}")
+    finally:
+        # Stopping early leaves yt-dlp running, so end it here
+        if process.poll() is None:
+            process.terminate()
+        process.wait()
+
+def iter_video_ids(channel_url, engine="subprocess"):
     """
-    command = ["yt-dlp", "--get-id", channel_url]
-    result = subprocess.run(command, capture_output=True, text=True)
+    Yield video IDs from a YouTube channel with the selected engine.
 
-    video_ids = result.stdout.strip().split("\n")
-    video_urls = [f"https://www.youtube.com/watch?v={video_id}" for video_id in video_ids]
+    Parameters:
+    - channel_url: The URL of the YouTube channel's videos page.
+    - engine: "api" to use the yt_dlp Python package, "subprocess" to run the yt-dlp command.
+      The command is used when the package is not installed.
 
-    return video_urls
+    Returns:
+    - A generator of video IDs, newest first.
+    """
+    if engine == "api":
+        try:
+            import yt_dlp
+            return iter_video_ids_api(channel_url)
+        except ImportError:
+            print("yt_dlp Python package is not found. Falling back to the yt-dlp command.")
+    return iter_video_ids_subprocess(channel_url)
 
-def write_urls_to_file(urls, file_path):
+def load_known_video_ids(data_folder, file_path):
     """
-    Write URLs to a specified file.
+    Collect the IDs of videos that are already queued or downloaded.
 
     Parameters:
-    - urls: A list of URLs to write.
-    - file_path: The path to the file where URLs will be written.
+    - data_folder: The yt-downloader-py data folder.
+    - file_path: The path to the download list file.
+
+    Returns:
+    - A set of video IDs.
     """
-    with open(file_path, "w") as file:
-        for url in urls:
+    known_ids = set()
+    if os.path.exists(file_path):
+        with open(file_path, "r") as file:
+            for line in file:
+                # Lines may carry tags after the URL, e.g. "priority=5"
+                fields = line.split()
+                video_id = extract_video_id(fields[0]) if fields else None
+                if video_id:
+                    known_ids.add(video_id)
+
+    ledger_path = os.path.join(data_folder, "download-ledger.sqlite3")
+    if os.path.exists(ledger_path):
+        connection = sqlite3.connect(ledger_path)
+        try:
+            rows = connection.execute("SELECT video_id FROM downloads WHERE status IN ('done', 'finalized')").fetchall()
+            known_ids.update(row[0] for row in rows)
+        except sqlite3.Error as e:
+            print(f"Error reading {ledger_path}. Error message: {e}")
+        finally:
+            connection.close()
+    return known_ids
+
+def load_channel_state(state_path):
+    """
+    Load the newest video ID seen for each channel on the last complete sync.
+
+    Parameters:
+    - state_path: The path to the channel state file.
+
+    Returns:
+    - A dict that maps channel URLs to video IDs.
+    """
+    if not os.path.exists(state_path):
+        return {}
+    with open(state_path, "r") as file:
+        return json.load(file)
+
+def save_channel_state(state_path, state):
+    """
+    Save the channel state file atomically.
+
+    Parameters:
+    - state_path: The path to the channel state file.
+    - state: A dict that maps channel URLs to video IDs.
+    """
+    tmp_path = state_path + ".tmp"
+    with open(tmp_path, "w") as file:
+        json.dump(state, file, indent=2)
+    os.replace(tmp_path, state_path)
+
+def append_url(file_path, url):
+    """
+    Append one URL to the download list.
+    The file is opened for each line, under the lock file the downloader takes while it
+    compacts the list, so the line never lands in a file that is being replaced.
+
+    Parameters:
+    - file_path: The path to the download list file.
+    - url: The URL to append.
+    """
+    with open(file_path + ".lock", "a") as lock_file:
+        if fcntl is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        with open(file_path, "a") as file:
             file.write(f"{url}\n")
-    print(f"URLs have been written to {file_path}")
+
+def sync_channel(channel_url, file_path, data_folder, engine="subprocess", full=False):
+    """
+    Append a channel's new video URLs to the download list as they are listed.
+    Enumeration stops at the newest video seen on the last complete sync, unless full is set.
+    Videos that are already queued or downloaded are skipped.
+
+    Parameters:
+    - channel_url: The URL of the YouTube channel's videos page.
+    - file_path: The path to the download list file.
+    - data_folder: The yt-downloader-py data folder.
+    - engine: "api" to use the yt_dlp Python package, "subprocess" to run the yt-dlp command.
+    - full: List the whole channel even if it was synced before.
+
+    Returns:
+    - The number of URLs appended to the download list.
+    """
+    state_path = os.path.join(data_folder, "channel-state.json")
+    state = load_channel_state(state_path)
+    last_seen_id = None if full else state.get(channel_url)
+    known_ids = load_known_video_ids(data_folder, file_path)
+
+    newest_id = None
+    added = 0
+    for video_id in tqdm(iter_video_ids(channel_url, engine), unit=" videos"):
+        if newest_id is None:
+            newest_id = video_id
+        if video_id == last_seen_id:
+            break
+        if video_id in known_ids:
+            continue
+        known_ids.add(video_id)
+        # Written one line at a time so a running downloader can pick it up right away
+        append_url(file_path, f"https://www.youtube.com/watch?v={video_id}")
+        added += 1
+
+    # Only move the marker after a sync that got all the way through
+    if newest_id is not None:
+        state[channel_url] = newest_id
+        save_channel_state(state_path, state)
+    return added
 
 def usage():
     """
@@ -64,14 +230,22 @@ Usage: python get_video_urls.py [options] <channel_url>
 
 Options:
   -h, --help            Show this help message and exit
+  --engine              How yt-dlp is run (choices: subprocess, api; default: subprocess)
+  --full                List the whole channel instead of stopping at the last synced video
   
 Examples:
-  1. Get all video URLs from a YouTube channel and save to the default file:
+  1. Add a YouTube channel's new video URLs to the default file:
      python get_video_urls.py "https://www.youtube.com/@LaelaKhanZa99/videos"
+
+  2. List the whole channel again:
+     python get_video_urls.py --full "https://www.youtube.com/@LaelaKhanZa99/videos"
      
 Description:
-  This script fetches all video URLs from a specified YouTube channel and saves them to a file.
-  The URLs will be written to the file located at ~/yt-downloader-py-data/download-list.txt.
+  This script lists the videos of a specified YouTube channel and appends their URLs to a file as they arrive.
+  The URLs will be appended to the file located at ~/yt-downloader-py-data/download-list.txt.
+  Videos that are already in the file or already downloaded are skipped.
+  The newest video of each channel is remembered in ~/yt-downloader-py-data/channel-state.json,
+  so the next run stops as soon as it reaches it.
   
 Note:
   Ensure that the provided URL is a valid YouTube channel's videos page URL.
@@ -81,6 +255,8 @@ Note:
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Get all video URLs from a YouTube channel and save to a file.", add_help=False)
     parser.add_argument("channel_url", nargs='?', help="The URL of the YouTube channel's videos page.")
+    parser.add_argument("--engine", choices=["subprocess", "api"], default="subprocess", help="How yt-dlp is run")
+    parser.add_argument("--full", action="store_true", help="List the whole channel instead of stopping at the last synced video")
     parser.add_argument("-h", "--help", action="store_true", help="Show this help message and exit")
     args = parser.parse_args()
 
@@ -93,9 +269,10 @@ if __name__ == "__main__":
     file_path = os.path.join(data_folder, "download-list.txt")
 
     print("Fetching video URLs...")
-    video_urls = get_video_urls(args.channel_url)
-
-    print("Writing URLs to file...")
-    write_urls_to_file(video_urls, file_path)
+    try:
+        added = sync_channel(args.channel_url, file_path, data_folder, args.engine, args.full)
+    except RuntimeError as e:
+        print(f"Error listing {args.channel_url}. Error message: {e}")
+        sys.exit(1)
 
-    print("URLs have been successfully fetched and written to file.")
+    print(f"{added} new URLs have been appended to {file_path}.")
@@ -0,0 +1,57 @@
+import os
+import sys
+import time
+import unittest
+
+SRC_FOLDER = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, SRC_FOLDER)
+import yt_downloader_py as downloader
+
+URLS = [f"https://www.youtube.com/watch?v=video{i:06d}" for i in range(3)]
+
+class LeasedQueueHandlerTest(unittest.TestCase):
+    # Drives LeasedQueueHandler over MemoryLeaseQueue with short leases, the way two
+    # machines share one queue file
+
+    def setUp(self):
+        self.queue = downloader.MemoryLeaseQueue()
+        self.queue.add(URLS)
+
+    def test_expired_lease_is_reclaimed(self):
+        # Never started, so it does not renew: like a worker that died holding its leases
+        dead = downloader.LeasedQueueHandler(self.queue, "dead", capacity=2, lease_time=0.2)
+        self.assertEqual(dead.get_urls(), URLS[:2])
+
+        alive = downloader.LeasedQueueHandler(self.queue, "alive", capacity=3, lease_time=0.2)
+        self.assertEqual(alive.get_urls(), URLS[2:])
+        time.sleep(0.3)
+        self.assertEqual(sorted(alive.read_new_urls()), sorted(URLS))
+        self.assertEqual(self.queue.entries[URLS[0]]["attempts"], 2)
+
+        for url in URLS:
+            alive.mark_done(url, "done")
+        self.assertEqual(self.queue.counts(), {"done": 3})
+
+    def test_renewed_lease_is_kept(self):
+        worker = downloader.LeasedQueueHandler(self.queue, "worker", capacity=1, lease_time=0.3)
+        worker.get_urls()
+        worker.start()
+        try:
+            time.sleep(0.6)
+            other = downloader.LeasedQueueHandler(self.queue, "other", capacity=3, lease_time=0.3)
+            self.assertNotIn(URLS[0], other.get_urls())
+        finally:
+            worker.stop()
+
+    def test_stop_releases_leases(self):
+        worker = downloader.LeasedQueueHandler(self.queue, "worker", capacity=3, lease_time=60)
+        self.assertEqual(worker.get_urls(), URLS)
+        worker.start()
+        worker.stop()
+        self.assertEqual(self.queue.counts(), {"pending": 3})
+
+        other = downloader.LeasedQueueHandler(self.queue, "other", capacity=3, lease_time=60)
+        self.assertEqual(other.get_urls(), URLS)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -2,14 +2,68 @@ import os
 import subprocess
 import argparse
 import sys
+import queue
+import threading
+import json
+import sqlite3
+import time
+import shutil
+import re
+import glob
+import signal
+import socket
+import contextlib
+import hashlib
+import heapq
+import collections
+import random
+from urllib.parse import urlparse, parse_qs
+
+try:
+    import fcntl
+except ImportError:
+    # Windows: SQLite's own locking is all there is
+    fcntl = None
+
+def load_dependency_cache(cache_path):
+    try:
+        with open(cache_path, "r") as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
+
+def save_dependency_cache(cache_path, cache):
+    write_file_atomically(cache_path, json.dumps(cache, indent=2))
+
+def probe_dependency(command, version_arg="--version", cache=None):
+    # The version check spawns the binary, so only run it when the binary itself changed
+    path = shutil.which(command)
+    if path is None:
+        return None
+    mtime = os.stat(path).st_mtime
+    entry = (cache or {}).get(command)
+    if entry and entry["path"] == path and entry["mtime"] == mtime:
+        return entry["version"]
 
-def check_dependency(command, install_command, version_arg="--version"):
     try:
-        subprocess.run([command, version_arg], check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        result = subprocess.run([path, version_arg], stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    except OSError:
+        return None
+    if result.returncode != 0:
+        return None
+    output = (result.stdout or result.stderr).strip()
+    version = output.splitlines()[0] if output else ""
+    if cache is not None:
+        cache[command] = {"path": path, "mtime": mtime, "version": version}
+    return version
+
+def check_dependency(command, install_command, version_arg="--version", cache=None):
+    if probe_dependency(command, version_arg, cache) is not None:
         print(f"{command} is already installed.")
-    except (subprocess.CalledProcessError, FileNotFoundError):
+    else:
         print(f"{command} is not found. Installing {command}...")
         subprocess.run(install_command, check=True)
+        probe_dependency(command, version_arg, cache)
         print(f"{command} is now installed.")
 
 def check_python_package(package_name, install_command):
@@ -21,14 +75,10 @@ def check_python_package(package_name, install_command):
         subprocess.run(install_command, check=True)
         print(f"{package_name} is now installed.")
 
-check_python_package("watchdog", [sys.executable, "-m", "pip", "install", "--user", "watchdog"])
-check_python_package("requests", [sys.executable, "-m", "pip", "install", "--user", "requests"])
-
-from watchdog.observers import Observer
-from watchdog.events import FileSystemEventHandler
-import requests
-
 def check_yt_dlp():
+    # Only imported for --setup, so a normal run does not pay for it
+    import requests
+
     yt_dlp_path = "/usr/local/bin/yt-dlp"
     yt_dlp_symlink = "/usr/bin/yt-dlp"
     
@@ -57,6 +107,33 @@ def check_yt_dlp():
     
     return True
 
+def setup_dependencies(data_folder):
+    cache_path = os.path.join(data_folder, "dependency-cache.json")
+    cache = load_dependency_cache(cache_path)
+    check_python_package("watchdog", [sys.executable, "-m", "pip", "install", "--user", "watchdog"])
+    check_python_package("requests", [sys.executable, "-m", "pip", "install", "--user", "requests"])
+    check_dependency("ffmpeg", ["sudo", "apt", "install", "-y", "ffmpeg"], version_arg="-version", cache=cache)
+    installed = check_yt_dlp()
+    probe_dependency("yt-dlp", cache=cache)
+    save_dependency_cache(cache_path, cache)
+    return installed
+
+def find_missing_dependencies(data_folder, engine):
+    cache_path = os.path.join(data_folder, "dependency-cache.json")
+    cache = load_dependency_cache(cache_path)
+    previous = json.dumps(cache, sort_keys=True)
+
+    missing = []
+    if probe_dependency("ffmpeg", "-version", cache) is None:
+        missing.append("ffmpeg")
+    # The api engine does not need the yt-dlp binary
+    if engine.name != "api" and probe_dependency("yt-dlp", "--version", cache) is None:
+        missing.append("yt-dlp")
+
+    if json.dumps(cache, sort_keys=True) != previous:
+        save_dependency_cache(cache_path, cache)
+    return missing
+
 def validate_download_folder():
     data_folder = os.path.expanduser("~/yt-downloader-py-data")
     download_folder = os.path.join(data_folder, "downloaded-yt-video")
@@ -67,124 +144,2332 @@ def validate_download_folder():
     else:
         print(f"Folder {download_folder} already exists.")
 
-def clean_url(url):
-    return url.split('&')[0]
+video_id_pattern = re.compile(r"^[A-Za-z0-9_-]{11}$")
+# youtube.com paths that carry the video ID as their second segment, e.g. /shorts/ID
+video_id_path_prefixes = ("shorts", "embed", "live", "v", "e")
 
-def fix_url_format(urls):
-    return [clean_url(url) for url in urls]
+def extract_video_id(url):
+    # Offline ID lookup so the ledger can be consulted and duplicates dropped without a network call
+    url = url.strip()
+    if "://" not in url:
+        url = "https://" + url
+    parsed = urlparse(url)
+    hostname = (parsed.hostname or "").lower()
+    segments = [segment for segment in parsed.path.split("/") if segment]
+    video_id = None
+    if hostname in ("youtu.be", "www.youtu.be"):
+        video_id = segments[0] if segments else None
+    elif hostname in ("youtube.com", "youtube-nocookie.com") or hostname.endswith((".youtube.com", ".youtube-nocookie.com")):
+        # m., music. and www. hosts; v= wins over list= and tracking parameters such as si=
+        video_id = parse_qs(parsed.query).get("v", [None])[0]
+        if video_id is None and len(segments) >= 2 and segments[0] in video_id_path_prefixes:
+            video_id = segments[1]
+    if video_id and video_id_pattern.match(video_id):
+        return video_id
+    return None
 
-def get_video_title(url):
-    try:
-        result = subprocess.run(["yt-dlp", "--get-title", url], capture_output=True, text=True)
-        if result.returncode == 0:
-            return result.stdout.strip()
-        else:
-            print(f"Error getting title for URL: {url}")
+def canonical_url(url):
+    # One spelling per video, so the same video behind different URL shapes is queued once
+    video_id = extract_video_id(url)
+    if video_id:
+        return f"https://www.youtube.com/watch?v={video_id}"
+    return url.strip().split("&")[0]
+
+# Each (video_id, quality) row moves through queued -> downloading -> merging -> finalized, or ends as failed
+class DownloadLedger:
+    def __init__(self, db_path, manifest=None):
+        self.db_path = db_path
+        # Every newly finalized file is handed to the manifest to be hashed
+        self.manifest = manifest
+        # One connection shared by the download workers, serialised by the lock
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(db_path, check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("""
+                CREATE TABLE IF NOT EXISTS downloads (
+                    video_id TEXT NOT NULL,
+                    quality TEXT NOT NULL,
+                    path TEXT,
+                    size INTEGER,
+                    status TEXT NOT NULL,
+                    updated_at REAL NOT NULL,
+                    url TEXT,
+                    PRIMARY KEY (video_id, quality)
+                )
+            """)
+            # Ledgers written before the state machine have no url column and call finalized "done"
+            columns = [row[1] for row in self.connection.execute("PRAGMA table_info(downloads)")]
+            if "url" not in columns:
+                self.connection.execute("ALTER TABLE downloads ADD COLUMN url TEXT")
+            self.connection.execute("UPDATE downloads SET status = 'finalized' WHERE status = 'done'")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS downloads_status ON downloads (status)")
+
+    def get(self, video_id, quality):
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT path, size, status, url FROM downloads WHERE video_id = ? AND quality = ?",
+                (video_id, quality)
+            ).fetchone()
+        if row is None:
             return None
-    except subprocess.CalledProcessError as e:
-        print(f"Error getting title for URL: {url}. Error message: {e}")
+        return {"video_id": video_id, "quality": quality, "path": row[0], "size": row[1], "status": row[2], "url": row[3]}
+
+    def is_downloaded(self, video_id, quality):
+        entry = self.get(video_id, quality) if video_id else None
+        return entry is not None and entry["status"] == "finalized" and bool(entry["path"]) and os.path.exists(entry["path"])
+
+    def record(self, video_id, quality, status, path=None, size=None, url=None):
+        if not video_id:
+            return
+        with self.lock, self.connection:
+            previous = None
+            if status == "finalized" and self.manifest is not None:
+                previous = self.connection.execute(
+                    "SELECT path, size, status FROM downloads WHERE video_id = ? AND quality = ?", (video_id, quality)
+                ).fetchone()
+            self.connection.execute(
+                "INSERT INTO downloads (video_id, quality, path, size, status, updated_at, url) VALUES (?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (video_id, quality) DO UPDATE SET "
+                "path = COALESCE(excluded.path, path), size = COALESCE(excluded.size, size), "
+                "status = excluded.status, updated_at = excluded.updated_at, url = COALESCE(excluded.url, url)",
+                (video_id, quality, path, size, status, time.time(), url)
+            )
+        # Re-recording a file that was already finalized, e.g. as the source of a rendition, does not hash it again
+        if status == "finalized" and path and self.manifest is not None and previous != (path, size, "finalized"):
+            self.manifest.add(video_id, quality, path)
+
+    def find(self, video_id):
+        # Finished files of a video by quality; the primary key doubles as the ID-to-path index
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT quality, path FROM downloads WHERE video_id = ? AND status = 'finalized'", (video_id,)
+            ).fetchall()
+        return dict(rows)
+
+    def interrupted(self):
+        # Downloads that were running when the process died
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT video_id, quality, path, size, status, url FROM downloads WHERE status IN ('downloading', 'merging')"
+            ).fetchall()
+        return [dict(zip(("video_id", "quality", "path", "size", "status", "url"), row)) for row in rows]
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+def make_video_record(info):
+    formats = []
+    for fmt in info.get("formats") or []:
+        formats.append({
+            "format_id": fmt.get("format_id"),
+            "ext": fmt.get("ext"),
+            "height": fmt.get("height"),
+            "vcodec": fmt.get("vcodec"),
+            "acodec": fmt.get("acodec"),
+            "filesize": fmt.get("filesize") or fmt.get("filesize_approx"),
+        })
+    return {
+        "id": info.get("id"),
+        "title": info.get("title"),
+        "duration": info.get("duration"),
+        "filesize": info.get("filesize") or info.get("filesize_approx"),
+        "webpage_url": info.get("webpage_url"),
+        "channel": info.get("channel_id") or info.get("uploader_id"),
+        "formats": formats,
+    }
+
+progress_line_prefix = "yt-downloader-py-progress "
+error_line_pattern = re.compile(r"^ERROR: \[[^\]]+\] ([\w-]+): (.*)$")
+
+# Matched against yt-dlp's error text, first match wins
+error_patterns = (
+    ("throttled", re.compile(r"HTTP Error 429|Too Many Requests|HTTP Error 403|rate.?limit|confirm you.re not a bot", re.IGNORECASE)),
+    ("permanent", re.compile(
+        r"Video unavailable|Private video|has been removed|members.only|not available in your country|"
+        r"copyright|Unsupported URL|is not a valid URL|HTTP Error 404|HTTP Error 410|account.+terminated",
+        re.IGNORECASE
+    )),
+    ("transient", re.compile(
+        r"timed? ?out|Connection (reset|refused|aborted)|Temporary failure|Name or service not known|"
+        r"HTTP Error 5\d\d|IncompleteRead|Remote end closed|Network is unreachable|giving up after",
+        re.IGNORECASE
+    )),
+)
+
+def classify_error(returncode, text):
+    # "throttled", "permanent", "transient" or "unknown"; yt-dlp exits with 2 on invalid options
+    if returncode == 2:
+        return "permanent"
+    for kind, pattern in error_patterns:
+        if pattern.search(text or ""):
+            return kind
+    return "unknown"
+
+class SubprocessEngine:
+    # Runs the yt-dlp binary once per operation
+    name = "subprocess"
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # Running yt-dlp processes and the URL each one downloads
+        self.processes = {}
+        # Exit code and error text of this thread's last download, for classify_error
+        self.local = threading.local()
+
+    def last_error(self):
+        return getattr(self.local, "error", (None, ""))
+
+    def cancel(self, urls=None):
+        # Stops the running downloads of `urls`, or all of them.
+        # yt-dlp keeps its .part files on SIGTERM, so the next run resumes them
+        with self.lock:
+            for process, url in self.processes.items():
+                if urls is None or url in urls:
+                    process.terminate()
+
+    def fetch_metadata(self, urls, errors=None):
+        # One yt-dlp process resolves the whole batch and prints one JSON object per video
+        command = ["yt-dlp", "--skip-download", "--ignore-errors", "--no-warnings", "--dump-json"] + urls
+        try:
+            result = subprocess.run(command, capture_output=True, text=True)
+        except (subprocess.CalledProcessError, FileNotFoundError) as e:
+            print(f"Error getting metadata for {len(urls)} URLs. Error message: {e}")
+            return {}
+
+        if errors is not None:
+            # "ERROR: [youtube] VIDEO_ID: reason", one line per video that failed
+            urls_by_id = {extract_video_id(url): url for url in urls}
+            for line in result.stderr.splitlines():
+                match = error_line_pattern.match(line)
+                if match and match.group(1) in urls_by_id:
+                    errors[urls_by_id[match.group(1)]] = match.group(2)
+
+        records = {}
+        for line in result.stdout.splitlines():
+            try:
+                info = json.loads(line)
+            except ValueError:
+                continue
+            record = make_video_record(info)
+            for key in ("original_url", "webpage_url"):
+                if info.get(key) in urls:
+                    records[info[key]] = record
+        return records
+
+    def download(self, url, format_option, output_template, progress_callback=None, options=None):
+        import tempfile
+
+        # yt-dlp writes the final path of each file here once it is moved into place
+        fd, filepath_log = tempfile.mkstemp(prefix="yt-downloader-py-", suffix=".txt")
+        os.close(fd)
+        command = [
+            "yt-dlp",
+            "-f", format_option,
+            "--merge-output-format", "mp4",
+            "--print-to-file", "after_move:filepath", filepath_log,
+            # One machine-readable line per progress update instead of the interactive bar
+            "--newline", "--progress-template", f"download:{progress_line_prefix}%(progress)j",
+            url,
+            "-o", output_template
+        ]
+        options = options or {}
+        if options.get("concurrent_fragments"):
+            command += ["--concurrent-fragments", str(options["concurrent_fragments"])]
+        if options.get("rate_limit"):
+            command += ["--limit-rate", str(options["rate_limit"])]
+        error_lines = []
+        try:
+            process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+            with self.lock:
+                self.processes[process] = url
+            for line in process.stdout:
+                if line.startswith("ERROR:"):
+                    error_lines.append(line.strip())
+                if line.startswith(progress_line_prefix):
+                    try:
+                        progress = json.loads(line[len(progress_line_prefix):])
+                    except ValueError:
+                        continue
+                    if progress_callback:
+                        progress_callback("download", progress)
+                    continue
+                if line.startswith("[Merger]") and progress_callback:
+                    progress_callback("merge", {})
+                if not options.get("quiet"):
+                    print(line, end="")
+            returncode = process.wait()
+            with self.lock:
+                self.processes.pop(process, None)
+            with open(filepath_log, "r") as file:
+                paths = [line.strip() for line in file if line.strip()]
+        finally:
+            os.remove(filepath_log)
+
+        self.local.error = (returncode, "\n".join(error_lines))
+        if returncode != 0:
+            return []
+        return paths
+
+class YtDlpApiEngine:
+    # Drives the yt_dlp Python API in this process. Each thread keeps its own YoutubeDL
+    # instances, so extractors and HTTP connections are reused across URLs.
+    name = "api"
+
+    def __init__(self):
+        import yt_dlp
+        self.yt_dlp = yt_dlp
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.cancelled = threading.Event()
+        # URLs being downloaded, and those of them cancelled on their own
+        self.running = set()
+        self.cancelled_urls = set()
+        self.cancel_error = getattr(yt_dlp.utils, "DownloadCancelled", yt_dlp.utils.DownloadError)
+
+    def cancel(self, urls=None):
+        # Picked up by the next progress hook call, which aborts the download.
+        # Without urls every download is cancelled, including later ones.
+        if urls is None:
+            self.cancelled.set()
+            return
+        with self.lock:
+            self.cancelled_urls.update(self.running.intersection(urls))
+
+    def last_error(self):
+        return getattr(self.local, "error", (None, ""))
+
+    def get_ydl(self, key, params):
+        instances = self.local.__dict__.setdefault("instances", {})
+        if key not in instances:
+            instances[key] = self.yt_dlp.YoutubeDL(params)
+        return instances[key]
+
+    def fetch_metadata(self, urls, errors=None):
+        ydl = self.get_ydl("metadata", {"quiet": True, "no_warnings": True, "skip_download": True})
+        records = {}
+        for url in urls:
+            try:
+                info = ydl.extract_info(url, download=False)
+            except self.yt_dlp.utils.DownloadError as e:
+                if errors is not None:
+                    errors[url] = str(e)
+                continue
+            if info:
+                records[url] = make_video_record(ydl.sanitize_info(info))
+        return records
+
+    def download(self, url, format_option, output_template, progress_callback=None, options=None):
+        key = ("download", format_option, output_template)
+        # The download this thread's instance is running. The hooks capture it rather than reading
+        # self.local, because yt-dlp also calls them from its fragment threads.
+        job = self.local.__dict__.setdefault("jobs", {}).setdefault(key, {})
+        ydl = self.get_ydl(key, {
+            "format": format_option,
+            "merge_output_format": "mp4",
+            "outtmpl": output_template,
+            "progress_hooks": [lambda status: self.on_progress(job, status)],
+            "postprocessor_hooks": [lambda status: self.on_postprocess(job, status)],
+            # Called with the final path of each file once it is moved into place
+            "post_hooks": [lambda filepath: job["paths"].append(filepath)],
+        })
+        options = options or {}
+        job.update(url=url, ydl=ydl, options=options, progress_callback=progress_callback, paths=[])
+        self.local.error = (None, "")
+        # Read by yt-dlp when each download starts, so the shared instance can change them per call
+        ydl.params["concurrent_fragment_downloads"] = options.get("concurrent_fragments") or 1
+        ydl.params["ratelimit"] = options.get("rate_limit")
+        ydl.params["quiet"] = ydl.params["noprogress"] = bool(options.get("quiet"))
+        with self.lock:
+            self.running.add(url)
+        try:
+            ydl.extract_info(url, download=True)
+        except (self.yt_dlp.utils.DownloadError, self.cancel_error) as e:
+            if not options.get("quiet"):
+                print(f"Error downloading URL: {url}. Error message: {e}")
+            self.local.error = (1, str(e))
+            return []
+        finally:
+            with self.lock:
+                self.running.discard(url)
+                self.cancelled_urls.discard(url)
+        return job["paths"]
+
+    def on_progress(self, job, status):
+        if self.cancelled.is_set() or job["url"] in self.cancelled_urls:
+            raise self.cancel_error("Download cancelled")
+        # yt-dlp reads ratelimit on every block, so a share re-balanced by the scheduler applies right away
+        job["ydl"].params["ratelimit"] = job["options"].get("rate_limit")
+        if job["progress_callback"]:
+            job["progress_callback"]("download", {k: v for k, v in status.items() if k != "info_dict"})
+
+    def on_postprocess(self, job, status):
+        if job["progress_callback"] and status.get("postprocessor") == "Merger" and status.get("status") == "started":
+            job["progress_callback"]("merge", {})
+
+def get_engine(name="subprocess"):
+    if name == "api":
+        try:
+            return YtDlpApiEngine()
+        except ImportError:
+            print("yt_dlp Python package is not found. Falling back to the yt-dlp command.")
+    return SubprocessEngine()
+
+class MetadataCache:
+    def __init__(self, db_path, ttl=7 * 24 * 3600, max_entries=10000):
+        self.db_path = db_path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(db_path, check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("""
+                CREATE TABLE IF NOT EXISTS metadata (
+                    video_id TEXT PRIMARY KEY,
+                    record TEXT NOT NULL,
+                    fetched_at REAL NOT NULL,
+                    accessed_at REAL NOT NULL
+                )
+            """)
+            self.connection.execute("CREATE INDEX IF NOT EXISTS metadata_accessed_at ON metadata (accessed_at)")
+
+    def get_many(self, video_ids):
+        video_ids = list(dict.fromkeys(video_id for video_id in video_ids if video_id))
+        now = time.time()
+        records = {}
+        with self.lock, self.connection:
+            # Stay below SQLite's limit on bound parameters
+            for i in range(0, len(video_ids), 500):
+                chunk = video_ids[i:i + 500]
+                placeholders = ",".join("?" * len(chunk))
+                rows = self.connection.execute(
+                    f"SELECT video_id, record FROM metadata WHERE video_id IN ({placeholders}) AND fetched_at >= ?",
+                    chunk + [now - self.ttl]
+                ).fetchall()
+                for video_id, record in rows:
+                    records[video_id] = json.loads(record)
+            self.connection.executemany(
+                "UPDATE metadata SET accessed_at = ? WHERE video_id = ?",
+                [(now, video_id) for video_id in records]
+            )
+        return records
+
+    def get(self, video_id):
+        return self.get_many([video_id]).get(video_id)
+
+    def put_many(self, records):
+        now = time.time()
+        rows = [(record["id"], json.dumps(record), now, now) for record in records if record and record.get("id")]
+        with self.lock, self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO metadata (video_id, record, fetched_at, accessed_at) VALUES (?, ?, ?, ?)",
+                rows
+            )
+            self.connection.execute("DELETE FROM metadata WHERE fetched_at < ?", (now - self.ttl,))
+            count = self.connection.execute("SELECT COUNT(*) FROM metadata").fetchone()[0]
+            if count > self.max_entries:
+                # Evict the least recently used entries
+                self.connection.execute(
+                    "DELETE FROM metadata WHERE video_id IN (SELECT video_id FROM metadata ORDER BY accessed_at LIMIT ?)",
+                    (count - self.max_entries,)
+                )
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+def hash_file(path, buffer_size=8 * 1024 * 1024):
+    # One large reusable buffer; hashlib releases the GIL while it hashes, so workers run in parallel
+    digest = hashlib.sha256()
+    buffer = bytearray(buffer_size)
+    view = memoryview(buffer)
+    with open(path, "rb", buffering=0) as file:
+        while True:
+            count = file.readinto(buffer)
+            if not count:
+                break
+            digest.update(view[:count])
+    return digest.hexdigest()
+
+class Manifest:
+    # NDJSON record per finished file (ID, quality, path, size, duration, SHA-256), appended as
+    # soon as the file is finalized. Hashing runs in a pool while the next downloads continue.
+    def __init__(self, path, jobs=2, cache=None):
+        self.path = path
+        self.jobs = max(1, jobs)
+        # Durations come from the metadata cache, so the manifest needs no network lookup
+        self.cache = cache
+        self.lock = threading.Lock()
+        # Started with the first file, so a run that finishes nothing does not import concurrent.futures
+        self.executor = None
+
+    def add(self, video_id, quality, path):
+        with self.lock:
+            if self.executor is None:
+                from concurrent.futures import ThreadPoolExecutor
+                self.executor = ThreadPoolExecutor(max_workers=self.jobs)
+        self.executor.submit(self.write_entry, video_id, quality, path)
+
+    def write_entry(self, video_id, quality, path):
+        try:
+            with tracer.span("checksum", path=path):
+                size = os.path.getsize(path)
+                sha256 = hash_file(path)
+            record = (self.cache.get(video_id) if self.cache is not None else None) or {}
+            entry = {
+                "id": video_id, "quality": quality, "path": path, "size": size,
+                "duration": record.get("duration"), "sha256": sha256, "finished_at": time.time(),
+            }
+            with self.lock, open(self.path, "a") as file:
+                file.write(json.dumps(entry) + "\n")
+                file.flush()
+                os.fsync(file.fileno())
+        except OSError as e:
+            print(f"Error adding {path} to the manifest. Error message: {e}")
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+
+def load_manifest(path):
+    # Later lines win, so a file that was downloaded again is checked against its newest record
+    entries = {}
+    with open(path, "r") as file:
+        for line in file:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # A line cut off by a crash
+                continue
+            entries[entry["path"]] = entry
+    return list(entries.values())
+
+def verify_entry(entry):
+    path = entry["path"]
+    if not os.path.exists(path):
+        return "missing"
+    size = os.path.getsize(path)
+    if size < entry["size"]:
+        return "truncated"
+    if size != entry["size"]:
+        return "size mismatch"
+    if hash_file(path) != entry["sha256"]:
+        return "corrupt"
+    return "ok"
+
+def verify_manifest(path, jobs=1):
+    from concurrent.futures import ThreadPoolExecutor
+
+    entries = load_manifest(path)
+    problems = 0
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+        for entry, result in zip(entries, executor.map(verify_entry, entries)):
+            if result != "ok":
+                problems += 1
+                print(f"{result}: {entry['path']} ({entry['id']}, {entry['quality']})")
+    print(f"Verified {len(entries)} files: {len(entries) - problems} ok, {problems} with problems.")
+    return problems == 0
+
+def fetch_video_metadata(urls, jobs=1, batch_size=50, cache=None, engine=None, errors=None):
+    # Imported here because it pulls in logging, which a run with nothing to look up never needs
+    from concurrent.futures import ThreadPoolExecutor
+
+    engine = engine or SubprocessEngine()
+    unique_urls = list(dict.fromkeys(urls))
+
+    records = {}
+    if cache is not None:
+        video_ids = {url: extract_video_id(url) for url in unique_urls}
+        cached = cache.get_many(video_ids.values())
+        for url, video_id in video_ids.items():
+            if video_id in cached:
+                records[url] = cached[video_id]
+
+    missing_urls = [url for url in unique_urls if url not in records]
+    batches = [missing_urls[i:i + batch_size] for i in range(0, len(missing_urls), batch_size)]
+    fetched = {}
+    def fetch_batch(batch):
+        with tracer.span("metadata-batch", urls=len(batch)):
+            return engine.fetch_metadata(batch, errors)
+
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+        for batch_records in executor.map(fetch_batch, batches):
+            fetched.update(batch_records)
+    if cache is not None and fetched:
+        cache.put_many(fetched.values())
+    records.update(fetched)
+
+    return {url: records.get(url) for url in unique_urls}
+
+def get_video_title(url, cache=None, engine=None):
+    record = fetch_video_metadata([url], cache=cache, engine=engine).get(url)
+    if record is None:
+        print(f"Error getting title for URL: {url}")
         return None
+    return record["title"]
+
+def parse_priority(tags):
+    for tag in tags:
+        name, _, value = tag.partition("=")
+        if name == "priority":
+            try:
+                return int(value)
+            except ValueError:
+                print(f"Ignoring invalid priority tag: {tag}")
+    return 0
 
-class DownloadListHandler(FileSystemEventHandler):
-    def __init__(self, file_path):
+class DownloadListHandler:
+    def __init__(self, file_path, journal_path=None, compact_threshold=1000):
         self.file_path = file_path
+        # Finished URLs are appended here instead of rewriting download-list.txt each time
+        self.journal_path = journal_path or os.path.splitext(file_path)[0] + ".journal"
+        self.compact_threshold = compact_threshold
+        # Guards urls, the read offset and both files; shared with the download workers
+        self.lock = threading.RLock()
+        self.offset = 0
+        self.tail = b""
+        self.completed = self.load_journal()
         self.urls = self.load_urls()
+        # Video records resolved by validate_download_list, keyed by canonical URL
+        self.metadata = {}
+        # Called from the watchdog thread after new URLs are read, used by the daemon to wake up
+        self.on_change = None
+
+    def dispatch(self, event):
+        # Called by the watchdog observer; only modifications of the list matter
+        if event.event_type == "modified":
+            self.on_modified(event)
 
     def on_modified(self, event):
         if event.src_path == self.file_path:
-            print(f"{self.file_path} has been modified. Reloading URLs...")
-            self.urls = self.load_urls()
+            print(f"{self.file_path} has been modified. Reading new URLs...")
+            self.read_new_urls()
+            if self.on_change:
+                self.on_change()
+
+    def load_journal(self):
+        # Canonical URL -> how far the list had been read when it was marked done. Lines before
+        # that offset are finished; a line appended later queues the URL again.
+        completed = {}
+        if not os.path.exists(self.journal_path):
+            return completed
+        with open(self.journal_path, "r") as file:
+            for line in file:
+                # A line without its newline was cut off by a crash and is ignored
+                if not line.startswith("done ") or not line.endswith("\n"):
+                    continue
+                fields = line.split()
+                if len(fields) == 3 and fields[1].isdigit():
+                    offset, url = int(fields[1]), fields[2]
+                elif len(fields) == 2:
+                    # Written before offsets were recorded: every line of the URL is finished
+                    offset, url = float("inf"), fields[1]
+                else:
+                    continue
+                key = canonical_url(url)
+                completed[key] = max(completed.get(key, 0), offset)
+        return completed
+
+    def is_completed(self, url, position):
+        # Whether the line starting at byte `position` of the list was finished
+        return position < self.completed.get(url, -1)
+
+    def parse_urls(self, data, start=0):
+        # Keyed by canonical URL and kept in list order; duplicates collapse here.
+        # The value is the line's priority tag, e.g. "https://youtu.be/ID priority=5".
+        # `start` is the byte offset of data in the list file.
+        urls = {}
+        position = start
+        for line in data.splitlines(keepends=True):
+            line_start = position
+            position += len(line)
+            fields = line.decode("utf-8", errors="replace").split()
+            if not fields:
+                continue
+            url = canonical_url(fields[0])
+            if not self.is_completed(url, line_start):
+                urls[url] = parse_priority(fields[1:])
+        return urls
 
     def load_urls(self):
-        with open(self.file_path, "r") as file:
-            urls = file.readlines()
-        return [url.strip() for url in urls if url.strip()]
+        with self.lock:
+            with open(self.file_path, "rb") as file:
+                data = file.read()
+            self.offset = len(data)
+            self.tail = data[-64:]
+            return self.parse_urls(data)
+
+    def read_new_urls(self):
+        with self.lock:
+            try:
+                with open(self.file_path, "rb") as file:
+                    size = file.seek(0, os.SEEK_END)
+                    file.seek(self.offset - len(self.tail))
+                    if size < self.offset or file.read(len(self.tail)) != self.tail:
+                        # The file was rewritten rather than appended to, so read it from the start
+                        self.urls = self.load_urls()
+                        return self.urls
+                    data = file.read()
+            except FileNotFoundError:
+                self.offset, self.tail, self.urls = 0, b"", {}
+                return self.urls
+
+            # Only consume complete lines; a partially written line is read once it is finished
+            end = data.rfind(b"\n") + 1
+            if end:
+                self.urls.update(self.parse_urls(data[:end], self.offset))
+                self.offset += end
+                self.tail = (self.tail + data[:end])[-64:]
+            return self.urls
+
+    def mark_done(self, url, status="done"):
+        # The journal only tracks that the URL left the list; the ledger keeps the result
+        with self.lock, tracer.span("journal", url):
+            key = canonical_url(url)
+            with open(self.journal_path, "a") as file:
+                file.write(f"done {self.offset} {key}\n")
+                file.flush()
+                os.fsync(file.fileno())
+            self.completed[key] = self.offset
+            self.urls.pop(key, None)
+            if len(self.completed) >= self.compact_threshold:
+                self.compact()
+
+    def compact(self):
+        # Appenders such as get_video_urls.py take the same lock file, so no line is written
+        # to the old file between the rewrite and os.replace
+        with self.lock, tracer.span("compact"), open(self.file_path + ".lock", "a") as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            with open(self.file_path, "rb") as file:
+                data = file.read()
+            tmp_path = self.file_path + ".tmp"
+            with open(tmp_path, "wb") as file:
+                position = 0
+                for line in data.splitlines(keepends=True):
+                    line_start = position
+                    position += len(line)
+                    fields = line.decode("utf-8", errors="replace").split()
+                    if fields and not self.is_completed(canonical_url(fields[0]), line_start):
+                        file.write(line)
+                # Keep anything appended while the list was being rewritten
+                with open(self.file_path, "rb") as source:
+                    source.seek(len(data))
+                    file.write(source.read())
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(tmp_path, self.file_path)
+            open(self.journal_path, "w").close()
+            self.completed = {}
+            self.urls = self.load_urls()
 
     def get_urls(self):
-        return self.urls
+        return list(self.urls)
+
+    def release(self, url):
+        # Nothing is leased; the URL just stays in the list
+        pass
 
 def monitor_file(file_path, handler):
+    try:
+        from watchdog.observers import Observer
+    except ImportError:
+        print("watchdog is not installed, so new URLs are only picked up between passes. Run with --setup to install it.")
+        return None
     observer = Observer()
     observer.schedule(handler, path=os.path.dirname(file_path), recursive=False)
     observer.start()
     return observer
 
-def validate_download_list(handler, video_quality):
-    data_folder = os.path.expanduser("~/yt-downloader-py-data")
-    download_folder = os.path.join(data_folder, "downloaded-yt-video")
+class SqliteLeaseQueue:
+    # Shared queue for several machines, kept in one SQLite file on shared storage. Workers lease
+    # URLs for a limited time and renew the lease while they work; a lease that runs out because
+    # its worker died is handed to the next worker that asks.
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.lock = threading.Lock()
+        # Network filesystems do not support WAL's shared memory, so keep the rollback journal
+        self.connection = sqlite3.connect(db_path, timeout=60, isolation_level=None, check_same_thread=False)
+        # SQLite's own locks are unreliable on some network filesystems, so writers also take a lock file
+        self.lock_path = db_path + ".lock"
+        with self.transaction():
+            self.connection.execute("""
+                CREATE TABLE IF NOT EXISTS queue (
+                    url TEXT PRIMARY KEY,
+                    status TEXT NOT NULL,
+                    worker TEXT,
+                    lease_expires REAL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    added_at REAL NOT NULL,
+                    finished_at REAL
+                )
+            """)
+            self.connection.execute("CREATE INDEX IF NOT EXISTS queue_status ON queue (status, lease_expires)")
+
+    @contextlib.contextmanager
+    def transaction(self):
+        with self.lock, open(self.lock_path, "a") as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                yield
+                self.connection.execute("COMMIT")
+            except BaseException:
+                self.connection.execute("ROLLBACK")
+                raise
+
+    def add(self, urls):
+        now = time.time()
+        with self.transaction():
+            # URLs that were queued before, including finished ones, are not added again
+            cursor = self.connection.executemany(
+                "INSERT OR IGNORE INTO queue (url, status, added_at) VALUES (?, 'pending', ?)",
+                [(url, now) for url in urls]
+            )
+        return cursor.rowcount
+
+    def lease(self, worker, limit, lease_time):
+        now = time.time()
+        with self.transaction():
+            urls = [row[0] for row in self.connection.execute(
+                "SELECT url FROM queue WHERE status = 'pending' OR (status = 'leased' AND lease_expires < ?) ORDER BY rowid LIMIT ?",
+                (now, limit)
+            )]
+            self.connection.executemany(
+                "UPDATE queue SET status = 'leased', worker = ?, lease_expires = ?, attempts = attempts + 1 WHERE url = ?",
+                [(worker, now + lease_time, url) for url in urls]
+            )
+        return urls
+
+    def renew(self, worker, urls, lease_time):
+        expires = time.time() + lease_time
+        with self.transaction():
+            self.connection.executemany(
+                "UPDATE queue SET lease_expires = ? WHERE url = ? AND worker = ? AND status = 'leased'",
+                [(expires, url, worker) for url in urls]
+            )
+
+    def release(self, worker, urls):
+        with self.transaction():
+            self.connection.executemany(
+                "UPDATE queue SET status = 'pending', worker = NULL, lease_expires = NULL WHERE url = ? AND worker = ? AND status = 'leased'",
+                [(url, worker) for url in urls]
+            )
+
+    def complete(self, worker, url, status):
+        with self.transaction():
+            self.connection.execute(
+                "UPDATE queue SET status = ?, worker = ?, lease_expires = NULL, finished_at = ? WHERE url = ?",
+                (status, worker, time.time(), url)
+            )
+
+    def counts(self):
+        with self.lock:
+            return dict(self.connection.execute("SELECT status, COUNT(*) FROM queue GROUP BY status").fetchall())
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+class MemoryLeaseQueue:
+    # In-process stand-in with the same interface as SqliteLeaseQueue, for trying out
+    # several workers in one process without shared storage (see tests/test_lease_queue.py).
+    # LeasedQueueHandler needs only these methods, so any other backend can take its place:
+    #   add(urls)                      queue URLs not seen before; returns how many were new
+    #   lease(worker, limit, lease_time)  up to `limit` pending or expired URLs, now leased to `worker`
+    #   renew(worker, urls, lease_time)   extend `worker`'s leases on `urls`
+    #   release(worker, urls)          hand `worker`'s unfinished `urls` back as pending
+    #   complete(worker, url, status)  record the result of `url`
+    #   counts()                       number of URLs per status
+    #   close()
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = {}
+
+    def add(self, urls):
+        added = 0
+        with self.lock:
+            for url in urls:
+                if url not in self.entries:
+                    self.entries[url] = {"status": "pending", "worker": None, "lease_expires": None, "attempts": 0}
+                    added += 1
+        return added
+
+    def lease(self, worker, limit, lease_time):
+        now = time.time()
+        urls = []
+        with self.lock:
+            for url, entry in self.entries.items():
+                if len(urls) >= limit:
+                    break
+                if entry["status"] == "pending" or (entry["status"] == "leased" and entry["lease_expires"] < now):
+                    entry.update(status="leased", worker=worker, lease_expires=now + lease_time, attempts=entry["attempts"] + 1)
+                    urls.append(url)
+        return urls
+
+    def renew(self, worker, urls, lease_time):
+        with self.lock:
+            for url in urls:
+                entry = self.entries.get(url)
+                if entry and entry["worker"] == worker and entry["status"] == "leased":
+                    entry["lease_expires"] = time.time() + lease_time
+
+    def release(self, worker, urls):
+        with self.lock:
+            for url in urls:
+                entry = self.entries.get(url)
+                if entry and entry["worker"] == worker and entry["status"] == "leased":
+                    entry.update(status="pending", worker=None, lease_expires=None)
+
+    def complete(self, worker, url, status):
+        with self.lock:
+            entry = self.entries.setdefault(url, {"attempts": 0})
+            entry.update(status=status, worker=worker, lease_expires=None)
+
+    def counts(self):
+        with self.lock:
+            counts = {}
+            for entry in self.entries.values():
+                counts[entry["status"]] = counts.get(entry["status"], 0) + 1
+            return counts
+
+    def close(self):
+        pass
+
+class LeasedQueueHandler:
+    # Takes the place of DownloadListHandler when URLs come from a shared lease queue.
+    # Holds at most `capacity` leases and renews them in the background while they are worked on.
+    def __init__(self, lease_queue, worker=None, capacity=2, lease_time=300):
+        self.queue = lease_queue
+        self.worker = worker or f"{socket.gethostname()}-{os.getpid()}"
+        self.capacity = max(1, capacity)
+        self.lease_time = lease_time
+        self.lock = threading.RLock()
+        # Leased URLs, keyed like DownloadListHandler.urls
+        self.urls = {}
+        # Nothing to compact: finished URLs are recorded in the shared queue right away
+        self.completed = set()
+        self.metadata = {}
+        self.on_change = None
+        # URLs handed back by release() and the time until which they are not leased again
+        self.held_back = {}
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def read_new_urls(self):
+        with self.lock:
+            missing = self.capacity - len(self.urls)
+            if missing > 0:
+                with tracer.span("lease"):
+                    leased = self.queue.lease(self.worker, missing, self.lease_time)
+                now = time.time()
+                self.held_back = {url: until for url, until in self.held_back.items() if until > now}
+                skipped = [url for url in leased if url in self.held_back]
+                if skipped:
+                    self.queue.release(self.worker, skipped)
+                for url in leased:
+                    if url not in self.held_back:
+                        self.urls[url] = None
+            return self.urls
+
+    def get_urls(self):
+        return list(self.read_new_urls())
+
+    def mark_done(self, url, status="done"):
+        with self.lock, tracer.span("journal", url):
+            key = canonical_url(url)
+            self.queue.complete(self.worker, key, status)
+            self.urls.pop(key, None)
+
+    def release(self, url):
+        # Hands back a URL this worker cannot take now, e.g. for lack of disk space, so another
+        # worker can; this one does not lease it again for one lease period
+        with self.lock:
+            key = canonical_url(url)
+            self.queue.release(self.worker, [key])
+            self.urls.pop(key, None)
+            self.held_back[key] = time.time() + self.lease_time
+
+    def compact(self):
+        pass
+
+    def run(self):
+        while not self.stopped.wait(self.lease_time / 3):
+            with self.lock:
+                urls = list(self.urls)
+            if urls:
+                self.queue.renew(self.worker, urls, self.lease_time)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+        # Hand unfinished URLs back now instead of letting other workers wait for the lease to run out
+        with self.lock:
+            if self.urls:
+                self.queue.release(self.worker, list(self.urls))
+                self.urls = {}
+
+class UrlListHandler:
+    # Takes the place of DownloadListHandler for a fixed list of URLs passed in by the caller,
+    # as download_many does. Nothing is written to disk; each result goes to on_done instead.
+    def __init__(self, urls):
+        self.lock = threading.RLock()
+        self.urls = {canonical_url(url): 0 for url in urls}
+        self.completed = set()
+        self.metadata = {}
+        self.on_change = None
+        # Called with (url, status) when a URL leaves the list, from the worker's thread
+        self.on_done = None
+
+    def read_new_urls(self):
+        return self.urls
+
+    def get_urls(self):
+        with self.lock:
+            return list(self.urls)
+
+    def mark_done(self, url, status="done"):
+        key = canonical_url(url)
+        with self.lock:
+            self.urls.pop(key, None)
+        if self.on_done:
+            self.on_done(key, status)
+
+    def release(self, url):
+        pass
+
+    def compact(self):
+        pass
+
+def write_file_atomically(path, text):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as file:
+        file.write(text)
+    os.replace(tmp_path, path)
+
+class Tracer:
+    # Timestamped spans for --profile, written as Chrome trace events (chrome://tracing or
+    # ui.perfetto.dev) plus a table of time per phase. Does nothing until enabled.
+    def __init__(self):
+        self.enabled = False
+        self.profiling = False
+        self.lock = threading.Lock()
+        self.events = []
+        self.thread_names = {}
+        self.started_at = time.time()
+        self.profile = None
+        self.profile_stats = None
+
+    def enable(self, profile_python=False):
+        self.enabled = True
+        self.started_at = time.time()
+        self.profiling = profile_python
+        if profile_python and sys.version_info >= (3, 12):
+            import cProfile
+            # One profiler sees every thread since 3.12, and a second one may not be started
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+
+    def add(self, name, start, end, url=None, tid=None, **args):
+        if not self.enabled:
+            return
+        if url:
+            args["url"] = url
+        tid = tid or threading.get_ident()
+        event = {
+            "name": name, "cat": "phase", "ph": "X", "pid": os.getpid(), "tid": tid,
+            "ts": int((start - self.started_at) * 1000000), "dur": int((end - start) * 1000000), "args": args,
+        }
+        with self.lock:
+            self.events.append(event)
+            if tid == threading.get_ident():
+                self.thread_names.setdefault(tid, threading.current_thread().name)
+
+    @contextlib.contextmanager
+    def span(self, name, url=None, **args):
+        if not self.enabled:
+            yield
+            return
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add(name, start, time.time(), url, **args)
+
+    def wrap(self, function):
+        # Runs function under its own cProfile profiler; before 3.12 each thread needs one
+        if not self.profiling or self.profile is not None:
+            return function
+        import cProfile
+        import pstats
+
+        def profiled(*args, **kwargs):
+            profile = cProfile.Profile()
+            profile.enable()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                profile.disable()
+                with self.lock:
+                    if self.profile_stats is None:
+                        self.profile_stats = pstats.Stats(profile)
+                    else:
+                        self.profile_stats.add(profile)
+
+        return profiled
+
+    def summary(self):
+        with self.lock:
+            events = list(self.events)
+        phases = {}
+        for event in events:
+            phase = phases.setdefault(event["name"], {"count": 0, "total": 0.0, "max": 0.0})
+            seconds = event["dur"] / 1000000
+            phase["count"] += 1
+            phase["total"] += seconds
+            phase["max"] = max(phase["max"], seconds)
+        lines = [f"{'phase':<16} {'count':>8} {'total s':>10} {'mean s':>10} {'max s':>10}"]
+        for name, phase in sorted(phases.items(), key=lambda item: -item[1]["total"]):
+            lines.append(f"{name:<16} {phase['count']:>8} {phase['total']:>10.3f} {phase['total'] / phase['count']:>10.3f} {phase['max']:>10.3f}")
+        return "\n".join(lines) + "\n"
+
+    def write(self, folder):
+        os.makedirs(folder, exist_ok=True)
+        with self.lock:
+            events = list(self.events)
+            names = [
+                {"name": "thread_name", "ph": "M", "pid": os.getpid(), "tid": tid, "args": {"name": name}}
+                for tid, name in self.thread_names.items()
+            ]
+        with open(os.path.join(folder, "trace.json"), "w") as file:
+            json.dump({"traceEvents": names + events, "displayTimeUnit": "ms"}, file)
+        summary = self.summary()
+        with open(os.path.join(folder, "summary.txt"), "w") as file:
+            file.write(summary)
+        print(summary, end="")
+
+        if self.profile is not None:
+            import pstats
+            self.profile.disable()
+            self.profile_stats = pstats.Stats(self.profile)
+        if self.profile_stats is not None:
+            self.profile_stats.dump_stats(os.path.join(folder, "profile.pstats"))
+            self.profile_stats.sort_stats("cumulative").print_stats(25)
+        print(f"Profile written to {folder}.")
+
+# Shared by every worker; enabled by --profile
+tracer = Tracer()
+
+class DownloadStats:
+    phases = ("metadata", "download", "merge", "transcode", "total")
+    # Upper bounds in seconds for the phase latency histograms
+    buckets = (1, 5, 15, 30, 60, 120, 300, 600, 1800, 3600, 7200)
+
+    def __init__(self, status_path=None, metrics_path=None, interval=1.0):
+        self.status_path = status_path
+        self.metrics_path = metrics_path
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.counts = {"queued": 0, "in_flight": 0, "done": 0, "failed": 0, "skipped": 0, "retried": 0}
+        self.downloaded_bytes = 0
+        self.active = {}
+        self.histograms = {phase: {"buckets": [0] * len(self.buckets), "sum": 0.0, "count": 0} for phase in self.phases}
+        self.started_at = time.time()
+        self.last_written = 0
+        # Called with (url, phase, progress) on every progress update, from the worker's thread
+        self.on_progress = None
+        # Serialises writers so two threads never share the temporary files
+        self.write_lock = threading.Lock()
+
+    def count(self, name, delta=1):
+        with self.lock:
+            self.counts[name] += delta
+        self.write()
+
+    def observe(self, phase, seconds):
+        with self.lock:
+            self.observe_locked(phase, seconds)
+
+    def observe_locked(self, phase, seconds):
+        histogram = self.histograms[phase]
+        for i, bound in enumerate(self.buckets):
+            if seconds <= bound:
+                histogram["buckets"][i] += 1
+        histogram["sum"] += seconds
+        histogram["count"] += 1
+
+    def start(self, url):
+        now = time.time()
+        with self.lock:
+            self.counts["queued"] -= 1
+            self.counts["in_flight"] += 1
+            self.active[url] = {"phase": "download", "started_at": now, "phase_started_at": now, "downloaded_bytes": 0, "tid": threading.get_ident()}
+        self.write()
+
+    def progress(self, url, phase, progress):
+        now = time.time()
+        with self.lock:
+            entry = self.active.get(url)
+            if entry is None:
+                return
+            if phase != entry["phase"]:
+                self.observe_locked(entry["phase"], now - entry["phase_started_at"])
+                tracer.add(entry["phase"], entry["phase_started_at"], now, url, entry["tid"])
+                entry["phase"] = phase
+                entry["phase_started_at"] = now
+                entry["tid"] = threading.get_ident()
+            downloaded = progress.get("downloaded_bytes")
+            if downloaded is not None:
+                # Each stream (video, then audio) counts up from zero again
+                previous = entry["downloaded_bytes"]
+                self.downloaded_bytes += downloaded - previous if downloaded >= previous else downloaded
+                entry["downloaded_bytes"] = downloaded
+            for key in ("total_bytes", "total_bytes_estimate", "speed", "eta", "fragment_index", "fragment_count"):
+                if key in progress:
+                    entry[key] = progress[key]
+        if self.on_progress:
+            self.on_progress(url, phase, progress)
+        self.write()
+
+    def finish(self, url, status):
+        now = time.time()
+        with self.lock:
+            entry = self.active.pop(url, None)
+            if entry is not None:
+                self.observe_locked(entry["phase"], now - entry["phase_started_at"])
+                self.observe_locked("total", now - entry["started_at"])
+                tracer.add(entry["phase"], entry["phase_started_at"], now, url, entry["tid"], status=status)
+                self.counts["in_flight"] -= 1
+            self.counts[status] += 1
+        self.write(force=True)
 
-    fixed_urls = fix_url_format(handler.get_urls())
+    def snapshot(self):
+        with self.lock:
+            return {
+                "updated_at": time.time(),
+                "uptime": time.time() - self.started_at,
+                "counts": dict(self.counts),
+                "downloaded_bytes": self.downloaded_bytes,
+                "speed": sum(entry.get("speed") or 0 for entry in self.active.values()),
+                "active": {url: {key: value for key, value in entry.items() if key != "tid"} for url, entry in self.active.items()},
+                "phases": {phase: {"count": h["count"], "sum": h["sum"]} for phase, h in self.histograms.items()},
+            }
+
+    def prometheus_text(self):
+        snapshot = self.snapshot()
+        with self.lock:
+            histograms = {phase: {"buckets": list(h["buckets"]), "sum": h["sum"], "count": h["count"]} for phase, h in self.histograms.items()}
+        lines = [
+            "# HELP yt_downloader_urls_total URLs finished since start, by result.",
+            "# TYPE yt_downloader_urls_total counter",
+        ]
+        for result in ("done", "failed", "skipped", "retried"):
+            lines.append(f'yt_downloader_urls_total{{result="{result}"}} {snapshot["counts"][result]}')
+        lines += [
+            "# HELP yt_downloader_urls_queued URLs waiting for a worker.",
+            "# TYPE yt_downloader_urls_queued gauge",
+            f"yt_downloader_urls_queued {snapshot['counts']['queued']}",
+            "# HELP yt_downloader_urls_in_flight URLs being downloaded or merged.",
+            "# TYPE yt_downloader_urls_in_flight gauge",
+            f"yt_downloader_urls_in_flight {snapshot['counts']['in_flight']}",
+            "# HELP yt_downloader_downloaded_bytes_total Bytes downloaded since start.",
+            "# TYPE yt_downloader_downloaded_bytes_total counter",
+            f"yt_downloader_downloaded_bytes_total {snapshot['downloaded_bytes']}",
+            "# HELP yt_downloader_speed_bytes Current download speed summed over all workers.",
+            "# TYPE yt_downloader_speed_bytes gauge",
+            f"yt_downloader_speed_bytes {snapshot['speed']}",
+            "# HELP yt_downloader_phase_duration_seconds Time spent in each phase.",
+            "# TYPE yt_downloader_phase_duration_seconds histogram",
+        ]
+        for phase, histogram in histograms.items():
+            for bound, value in zip(self.buckets, histogram["buckets"]):
+                lines.append(f'yt_downloader_phase_duration_seconds_bucket{{phase="{phase}",le="{bound}"}} {value}')
+            lines.append(f'yt_downloader_phase_duration_seconds_bucket{{phase="{phase}",le="+Inf"}} {histogram["count"]}')
+            lines.append(f'yt_downloader_phase_duration_seconds_sum{{phase="{phase}"}} {histogram["sum"]}')
+            lines.append(f'yt_downloader_phase_duration_seconds_count{{phase="{phase}"}} {histogram["count"]}')
+        return "\n".join(lines) + "\n"
+
+    def write(self, force=False):
+        if not self.status_path and not self.metrics_path:
+            return
+        now = time.time()
+        with self.lock:
+            if not force and now - self.last_written < self.interval:
+                return
+            self.last_written = now
+        with self.write_lock:
+            if self.status_path:
+                write_file_atomically(self.status_path, json.dumps(self.snapshot(), indent=2))
+            if self.metrics_path:
+                write_file_atomically(self.metrics_path, self.prometheus_text())
+
+def format_progress(progress):
+    downloaded = progress.get("downloaded_bytes") or 0
+    total = progress.get("total_bytes") or progress.get("total_bytes_estimate")
+    text = f"{downloaded / 1048576:.1f} MiB"
+    if total:
+        text += f" of {total / 1048576:.1f} MiB ({downloaded / total:.0%})"
+    if progress.get("speed"):
+        text += f" at {progress['speed'] / 1048576:.2f} MiB/s"
+    if progress.get("eta") is not None:
+        text += f", ETA {int(progress['eta'])}s"
+    return text
+
+def make_progress_callback(url, stats, print_interval=10, verbose=True):
+    last_printed = [0]
+
+    def on_progress(phase, progress):
+        stats.progress(url, phase, progress)
+        if not verbose:
+            return
+        if phase == "merge":
+            print(f"[progress] {url}: merging video and audio")
+        elif phase == "transcode":
+            print(f"[progress] {url}: deriving lower qualities")
+        elif time.time() - last_printed[0] >= print_interval:
+            last_printed[0] = time.time()
+            print(f"[progress] {url}: {format_progress(progress)}")
+
+    return on_progress
+
+def validate_download_list(handler, video_quality, jobs=1, ledger=None, cache=None, engine=None, stats=None, renditions=(), layout="flat", retries=None, download_folder=None, verbose=True):
+    download_folder = download_folder or os.path.join(os.path.expanduser("~/yt-downloader-py-data"), "downloaded-yt-video")
+    stats = stats or DownloadStats()
+    qualities = [video_quality] + list(renditions)
+
+    fixed_urls = []
+    for url in handler.get_urls():
+        # Skip URLs the ledger already knows are downloaded, before any network call
+        video_id = extract_video_id(url)
+        if ledger is not None and all(ledger.is_downloaded(video_id, quality) for quality in qualities):
+            if verbose:
+                print(f"Video {url} with quality {', '.join(qualities)} is already downloaded. Removing from the list.")
+            handler.mark_done(url, "skipped")
+            stats.count("skipped")
+            continue
+        fixed_urls.append(url)
+
+    started_at = time.time()
+    errors = {}
+    with tracer.span("metadata", urls=len(fixed_urls)):
+        handler.metadata = fetch_video_metadata(fixed_urls, jobs, cache=cache, engine=engine, errors=errors)
+    stats.observe("metadata", time.time() - started_at)
     
     valid_urls = []
     for url in fixed_urls:
-        video_title = get_video_title(url)
-        if video_title is None:
-            print(f"Invalid URL: {url}. Removing from the list.")
+        record = handler.metadata.get(url)
+        if record is None:
+            kind = classify_error(1, errors.get(url, ""))
+            if retries is not None and kind in ("throttled", "transient"):
+                # Not the URL's fault; the download itself looks it up again later
+                if kind == "throttled":
+                    retries.trip()
+                if verbose:
+                    print(f"Could not look up {url} ({kind} error). Keeping it in the list.")
+                valid_urls.append(url)
+                continue
+            if verbose:
+                print(f"Invalid URL: {url}. Removing from the list.")
             continue
 
-        video_path = os.path.join(download_folder, f"{video_title}_{video_quality}.mp4")
-        
-        if os.path.exists(video_path):
-            print(f"Video {url} with title {video_title} and quality {video_quality} is already downloaded. Removing from the list.")
-            if url in handler.urls:
-                handler.urls.remove(url)
+        video_title = record["title"]
+        downloaded = []
+        for quality in qualities:
+            video_path = get_video_path(download_folder, record, quality, layout)
+            already_downloaded = ledger is not None and ledger.is_downloaded(record["id"], quality)
+            if ledger is not None and not already_downloaded and os.path.exists(video_path):
+                ledger.record(record["id"], quality, "finalized", video_path, os.path.getsize(video_path), url)
+            if already_downloaded or os.path.exists(video_path):
+                downloaded.append(quality)
+
+        if len(downloaded) == len(qualities):
+            if verbose:
+                print(f"Video {url} with title {video_title} and quality {', '.join(qualities)} is already downloaded. Removing from the list.")
+            handler.mark_done(url, "skipped")
+            stats.count("skipped")
             continue
         
-        valid_urls.append(url)  # Use the original URL for downloading
+        # A source that is already on disk stays finalized; only its missing renditions are derived
+        if ledger is not None and video_quality not in downloaded:
+            ledger.record(record["id"], video_quality, "queued", url=url)
+        valid_urls.append(url)
     
     return valid_urls
 
-def batch_download_videos(video_quality, handler):
-    data_folder = os.path.expanduser("~/yt-downloader-py-data")
-    download_folder = os.path.join(data_folder, "downloaded-yt-video")
-    download_list_path = os.path.join(data_folder, "download-list.txt")
-
+def get_format_option(video_quality):
     quality_map = {
         "best": "bestvideo[ext=mp4]+bestaudio[ext=m4a]/best[ext=mp4]",
         "1080p": "bestvideo[height<=1080][ext=mp4]+bestaudio[ext=m4a]/best[height<=1080][ext=mp4]",
         "720p": "bestvideo[height<=720][ext=mp4]+bestaudio[ext=m4a]/best[height<=720][ext=mp4]",
         "480p": "bestvideo[height<=480][ext=mp4]+bestaudio[ext=m4a]/best[height<=480][ext=mp4]"
     }
-    
-    format_option = quality_map.get(video_quality, quality_map["best"])
+    return quality_map.get(video_quality, quality_map["best"])
 
-    while True:
-        urls = handler.get_urls()
-        if not urls:
-            print("Download process stopped because no valid URLs found in download-list.txt.")
-            break
+# Highest first; the first requested quality is downloaded and the rest are derived from it
+quality_order = ("best", "1080p", "720p", "480p")
+quality_heights = {"1080p": 1080, "720p": 720, "480p": 480}
+
+def get_split_format_option(format_option):
+    # "video+audio/fallback" becomes "(video,audio)/fallback": yt-dlp downloads each stream
+    # as a file of its own and leaves the merge to us
+    merged, _, fallback = format_option.partition("/")
+    split = "(" + merged.replace("+", ",") + ")"
+    return f"{split}/{fallback}" if fallback else split
+
+# Subfolders of downloaded-yt-video per layout, as yt-dlp template fields
+layouts = {
+    "flat": None,
+    "channel": "%(channel_id,uploader_id|NA)s",
+    "id-prefix": "%(id).2s",
+}
+
+def get_output_folder(download_folder, layout="flat"):
+    return os.path.join(download_folder, layouts[layout]) if layouts[layout] else download_folder
+
+def get_video_path(download_folder, record, video_quality, layout="flat"):
+    # Where yt-dlp will put this video, resolved the same way as the template in get_output_folder
+    folder = download_folder
+    if layout == "channel":
+        folder = os.path.join(folder, record.get("channel") or "NA")
+    elif layout == "id-prefix":
+        folder = os.path.join(folder, (record.get("id") or "NA")[:2])
+    return os.path.join(folder, f"{record['title']}_{video_quality}.mp4")
+
+def download_video(url, format_option, download_folder, video_quality, engine=None, progress_callback=None, options=None):
+    engine = engine or SubprocessEngine()
+    # The quality suffix is part of the template, so the final name is known up front
+    output_template = os.path.join(download_folder, f"%(title)s_{video_quality}.%(ext)s")
+    paths = engine.download(url, format_option, output_template, progress_callback, options)
+    return paths[-1] if paths else None
+
+def download_streams(url, format_option, download_folder, video_quality, engine=None, progress_callback=None, options=None):
+    engine = engine or SubprocessEngine()
+    # Same names yt-dlp gives the streams of a merged download, so recover_downloads finds them too
+    output_template = os.path.join(download_folder, f"%(title)s_{video_quality}.f%(format_id)s.%(ext)s")
+    return engine.download(url, get_split_format_option(format_option), output_template, progress_callback, options)
+
+def parse_rate(text):
+    # "500K", "2M", "1.5G" in bytes per second; "0" or "" means unlimited
+    text = (text or "").strip().upper()
+    if not text or text == "0":
+        return None
+    multiplier = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}.get(text[-1], 1)
+    number = text[:-1] if text[-1] in "KMG" else text
+    return int(float(number) * multiplier)
+
+def parse_bandwidth_window(text):
+    # "HH:MM-HH:MM=RATE", for example "08:00-18:00=1M"
+    span, rate = text.split("=", 1)
+    start, end = span.split("-", 1)
+    to_minutes = lambda value: int(value.split(":")[0]) * 60 + int(value.split(":")[1])
+    return to_minutes(start), to_minutes(end), parse_rate(rate)
+
+class BandwidthScheduler:
+    # Hands out download slots. The number of slots follows measured throughput, and each
+    # download gets a share of the global rate cap and of the fragment concurrency.
+    # With a live engine (the api engine picks up a new rate limit mid-download) the cap is split
+    # between the running downloads and re-split whenever one starts or ends, or the window changes.
+    # The yt-dlp command keeps the rate it was started with, so there each download gets its share
+    # with all max_jobs slots busy: conservative, but the sum never exceeds the cap.
+    def __init__(self, stats, max_jobs, max_rate=None, max_per_host=None, windows=(), max_fragments=4, adaptive=True, interval=10, live=False):
+        self.stats = stats
+        self.max_jobs = max(1, max_jobs)
+        self.max_rate = max_rate
+        self.max_per_host = max_per_host
+        self.windows = list(windows)
+        self.max_fragments = max(1, max_fragments)
+        self.adaptive = adaptive
+        self.interval = interval
+        self.limit = 1 if adaptive else self.max_jobs
+        self.condition = threading.Condition()
+        self.active = {}
+        self.host_counts = {}
+        self.live = live
+        # Options handed to the engine for each active URL; a live engine re-reads rate_limit
+        self.options = {}
+        self.last_bytes = 0
+        self.last_time = time.time()
+        self.last_throughput = 0
+        self.last_step = 0
+        self.probe_backoff = 1
+        self.hold = 0
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def current_rate_cap(self):
+        now = time.localtime()
+        minutes = now.tm_hour * 60 + now.tm_min
+        for start, end, rate in self.windows:
+            # A window such as 22:00-06:00 wraps past midnight
+            inside = start <= minutes < end if start <= end else minutes >= start or minutes < end
+            if inside:
+                return rate
+        return self.max_rate
+
+    def can_start(self, host):
+        if len(self.active) >= self.limit:
+            return False
+        return not self.max_per_host or self.host_counts.get(host, 0) < self.max_per_host
+
+    def acquire(self, url, stopping=None):
+        host = urlparse(url).hostname or ""
+        with self.condition:
+            while not self.can_start(host):
+                if stopping is not None and stopping.is_set():
+                    return None
+                self.condition.wait(timeout=1)
+            self.active[url] = host
+            self.host_counts[host] = self.host_counts.get(host, 0) + 1
+            # Fragment concurrency is fixed once a download starts, whatever the engine
+            self.options[url] = {"concurrent_fragments": max(1, self.max_fragments // self.max_jobs)}
+            self.apply_shares_locked()
+            return self.options[url]
+
+    def apply_shares_locked(self):
+        rate_cap = self.current_rate_cap()
+        divisor = max(1, len(self.active)) if self.live else self.max_jobs
+        for options in self.options.values():
+            options["rate_limit"] = max(1, rate_cap // divisor) if rate_cap else None
+
+    def release(self, url):
+        with self.condition:
+            host = self.active.pop(url, None)
+            if host is not None:
+                self.host_counts[host] -= 1
+            self.options.pop(url, None)
+            self.apply_shares_locked()
+            self.condition.notify_all()
+
+    def adjust(self):
+        now = time.time()
+        downloaded = self.stats.downloaded_bytes
+        throughput = (downloaded - self.last_bytes) / max(now - self.last_time, 1e-6)
+        self.last_bytes, self.last_time = downloaded, now
+
+        with self.condition:
+            previous_limit = self.limit
+            rate_cap = self.current_rate_cap()
+            # Only probe while every slot is busy; otherwise throughput says nothing about the limit
+            if self.adaptive and len(self.active) >= self.limit:
+                if self.last_throughput and throughput < self.last_throughput * 0.5:
+                    # Throughput collapsed, most likely throttling
+                    self.limit = max(1, self.limit // 2)
+                    self.last_step = -1
+                elif self.last_step > 0 and throughput < self.last_throughput * 1.05:
+                    # The last extra download did not add throughput, so the link is saturated.
+                    # Wait longer before each new probe while that keeps being the case.
+                    self.limit = max(1, self.limit - 1)
+                    self.last_step = -1
+                    self.probe_backoff = min(self.probe_backoff * 2, 32)
+                    self.hold = self.probe_backoff
+                elif self.hold > 0:
+                    self.hold -= 1
+                    self.last_step = 0
+                elif self.limit < self.max_jobs and not (rate_cap and throughput >= rate_cap * 0.9):
+                    if self.last_step > 0:
+                        self.probe_backoff = 1
+                    self.limit += 1
+                    self.last_step = 1
+                else:
+                    self.last_step = 0
+            self.last_throughput = throughput
+            # Picks up a bandwidth window that started or ended since the last check
+            self.apply_shares_locked()
+            self.condition.notify_all()
+
+        if self.limit != previous_limit:
+            print(f"Throughput {throughput / 1048576:.2f} MiB/s. Concurrent downloads: {previous_limit} -> {self.limit}")
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.adjust()
+
+    def start(self):
+        self.last_bytes = self.stats.downloaded_bytes
+        self.last_time = time.time()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
 
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+
+def estimate_size(record, assumed_rate=250000, unknown_duration=600):
+    # Bytes a video will take: its file size if the metadata has one, otherwise its duration
+    # (or ten minutes) at a typical bitrate
+    record = record or {}
+    if record.get("filesize"):
+        return record["filesize"]
+    return (record.get("duration") or unknown_duration) * assumed_rate
+
+class DiskAdmission:
+    # Admits a download only if its estimated size fits in the free space that is left after
+    # the reserve and the downloads admitted before it. Each download reserves twice its estimate,
+    # for the streams and the merged file, until it is finished.
+    def __init__(self, folder, reserve=0, headroom=2.0, interval=30):
+        self.folder = folder
+        self.reserve = reserve or 0
+        self.headroom = headroom
+        self.interval = interval
+        self.condition = threading.Condition()
+        self.reserved = {}
+
+    def available(self):
+        return shutil.disk_usage(self.folder).free - self.reserve - sum(self.reserved.values())
+
+    def acquire(self, url, size, stopping=None):
+        needed = size * self.headroom
+        with self.condition:
+            while True:
+                if needed <= self.available():
+                    self.reserved[url] = needed
+                    return True
+                if not self.reserved or (stopping is not None and stopping.is_set()):
+                    # Nothing in flight will hand space back, so waiting would not help
+                    return False
+                # Running downloads reserved their worst case; measure again when one finishes
+                self.condition.wait(self.interval)
+
+    def release(self, url):
+        with self.condition:
+            if self.reserved.pop(url, None) is not None:
+                self.condition.notify_all()
+
+class RetryPolicy:
+    # Decides whether a failed URL is tried again and when. Each retry waits an exponentially
+    # growing delay with full jitter, so workers that failed together do not come back together.
+    # A throttling error also trips a shared circuit breaker that holds back every new download
+    # for a cooldown, which doubles while throttling persists and resets on the next success.
+    def __init__(self, max_attempts=3, base_delay=30, max_delay=900, cooldown=60, max_cooldown=900):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.lock = threading.Lock()
+        self.attempts = {}
+        # (due time, URL) heap of retries waiting for their backoff to pass
+        self.due = []
+        self.paused_until = 0
+        self.trips = 0
+
+    def failure(self, url, kind):
+        # Returns the delay before the retry, or None if the URL should not be retried
+        with self.lock:
+            if kind == "throttled":
+                self.trip_locked()
+            if kind == "permanent":
+                return None
+            attempts = self.attempts.get(url, 0) + 1
+            self.attempts[url] = attempts
+            if attempts > self.max_attempts:
+                return None
+            delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempts - 1)))
+            heapq.heappush(self.due, (time.time() + delay, url))
+            return delay
+
+    def success(self, url):
+        with self.lock:
+            self.attempts.pop(url, None)
+            self.trips = 0
+
+    def trip(self):
+        with self.lock:
+            self.trip_locked()
+
+    def trip_locked(self):
+        now = time.time()
+        if now < self.paused_until:
+            # Already paused: other downloads throttled at the same moment do not escalate it
+            return
+        cooldown = min(self.max_cooldown, self.cooldown * 2 ** self.trips)
+        self.paused_until = now + cooldown
+        self.trips += 1
+        print(f"Throttled by the remote site. Pausing new downloads for {cooldown:.0f}s.")
+
+    def wait_for_dispatch(self, stopping=None):
+        # Blocks while the breaker is open; False if shutdown started meanwhile
+        while True:
+            remaining = self.paused_until - time.time()
+            if remaining <= 0:
+                return True
+            if stopping is not None:
+                if stopping.wait(min(remaining, 1)):
+                    return False
+            else:
+                time.sleep(min(remaining, 1))
+
+    def pop_due(self):
+        now = time.time()
+        urls = []
+        with self.lock:
+            while self.due and self.due[0][0] <= now:
+                urls.append(heapq.heappop(self.due)[1])
+        return urls
+
+    def waiting(self):
+        with self.lock:
+            return len(self.due)
+
+class QueuePolicy:
+    # Orders the URLs handed to the download workers. Higher priority tags always go first;
+    # the policy decides among URLs of equal priority:
+    #   fifo      list order
+    #   shortest  smallest estimated size first, so short clips are not stuck behind long streams
+    #   fair      the channel with the fewest bytes scheduled so far goes next
+    policies = ("fifo", "shortest", "fair")
+
+    def __init__(self, name="fifo"):
+        self.name = name
+        # Estimated bytes handed to workers per channel, kept across calls so fairness spans the whole run
+        self.channel_bytes = {}
+
+    def order(self, urls, handler):
+        def priority(url):
+            return -(handler.urls.get(url) or 0)
+
+        if self.name == "shortest":
+            return sorted(urls, key=lambda url: (priority(url), estimate_size(handler.metadata.get(url))))
+        if self.name != "fair":
+            return sorted(urls, key=priority)
+
+        # Takes turns on a copy; a channel is only charged for URLs that are dispatched
+        channel_bytes = dict(self.channel_bytes)
+        ordered = []
+        levels = {}
         for url in urls:
-            command = [
-                "yt-dlp",
-                "-f", format_option,
-                "--merge-output-format", "mp4",
-                url,
-                "-o", os.path.join(download_folder, f"%(title)s.%(ext)s")
-            ]
-            
-            subprocess.run(command)
-
-            # Rename files after download and merge
-            for root, _, files in os.walk(download_folder):
-                for file in files:
-                    if file.endswith(".mp4") and not file.endswith(f"_{video_quality}.mp4"):
-                        base, ext = os.path.splitext(file)
-                        new_name = f"{base}_{video_quality}{ext}"
-                        os.rename(os.path.join(root, file), os.path.join(root, new_name))
-
-            # Remove the processed URL from the handler and download list file
-            if url in handler.urls:
-                handler.urls.remove(url)
-            with open(download_list_path, "r") as file:
-                lines = file.readlines()
-            with open(download_list_path, "w") as file:
-                for line in lines:
-                    if clean_url(line.strip()) != clean_url(url):
-                        file.write(line)
+            levels.setdefault(priority(url), []).append(url)
+        for level in sorted(levels):
+            channels = {}
+            for url in levels[level]:
+                channel = (handler.metadata.get(url) or {}).get("channel")
+                channels.setdefault(channel, []).append(url)
+            while channels:
+                channel = min(channels, key=lambda name: channel_bytes.get(name, 0))
+                url = channels[channel].pop(0)
+                if not channels[channel]:
+                    del channels[channel]
+                channel_bytes[channel] = channel_bytes.get(channel, 0) + estimate_size(handler.metadata.get(url))
+                ordered.append(url)
+        return ordered
+
+    def dispatched(self, url, handler):
+        # Called once a URL is handed to a worker
+        if self.name == "fair":
+            record = handler.metadata.get(url) or {}
+            self.channel_bytes[record.get("channel")] = self.channel_bytes.get(record.get("channel"), 0) + estimate_size(record)
+
+# yt-dlp names each stream of a merged download <title>_<quality>.f<format_id>.<ext>. Anchored to
+# the quality suffix, so a title with ".f" in it (e.g. "Mr.freeze_best.mp4") is not taken for a stream.
+stream_file_pattern = re.compile(r"_(" + "|".join(quality_order) + r")\.f[A-Za-z0-9-]+\.\w+$")
+
+def get_final_path(stream_path):
+    return stream_file_pattern.sub(r"_\1.mp4", stream_path)
+
+def track_download_state(progress_callback, ledger, video_id, video_quality):
+    # Records state changes in the ledger once each, not on every progress update
+    state = {"path": None, "merging": False}
+
+    def on_progress(phase, progress):
+        progress_callback(phase, progress)
+        if phase == "merge" and not state["merging"]:
+            state["merging"] = True
+            ledger.record(video_id, video_quality, "merging")
+        elif phase == "download" and progress.get("filename") and state["path"] is None:
+            # The expected final path, so a restart can find this download's stream files
+            state["path"] = get_final_path(progress["filename"])
+            ledger.record(video_id, video_quality, "downloading", state["path"])
+
+    return on_progress
+
+def merge_streams(stream_paths, final_path):
+    temp_path = os.path.splitext(final_path)[0] + ".temp.mp4"
+    command = ["ffmpeg", "-y", "-loglevel", "error"]
+    for stream_path in stream_paths:
+        command += ["-i", stream_path]
+    for i in range(len(stream_paths)):
+        command += ["-map", str(i)]
+    command += ["-c", "copy", temp_path]
+    if subprocess.run(command).returncode != 0 or not os.path.exists(temp_path):
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        return False
+    os.replace(temp_path, final_path)
+    for stream_path in stream_paths:
+        os.remove(stream_path)
+    return True
 
-        # Update download list in memory
-        handler.urls = handler.load_urls()
+def recover_downloads(ledger, handler):
+    with tracer.span("recover"):
+        for entry in ledger.interrupted():
+            video_id, quality, path, url = entry["video_id"], entry["quality"], entry["path"], entry["url"]
+            if not path:
+                # Killed before the first byte arrived; the URL is still in the list and starts over
+                ledger.record(video_id, quality, "queued")
+                continue
+
+            if os.path.exists(path):
+                # The merge finished and moved the file into place, only the bookkeeping is missing
+                print(f"Recovered finished download {path}.")
+                ledger.record(video_id, quality, "finalized", path, os.path.getsize(path))
+                if url:
+                    handler.mark_done(url)
+                continue
+
+            base = os.path.splitext(path)[0]
+            streams = [stream for stream in glob.glob(glob.escape(base) + ".f*.*") if stream_file_pattern.search(stream)]
+            partial = glob.glob(glob.escape(base) + ".f*.part")
+            if len(streams) >= 2 and not partial:
+                # Every stream was downloaded but the merge did not finish, so merge locally instead of fetching again
+                print(f"Merging orphaned streams for {path}...")
+                if merge_streams(sorted(streams), path):
+                    ledger.record(video_id, quality, "finalized", path, os.path.getsize(path))
+                    if url:
+                        handler.mark_done(url)
+                    continue
+
+            # yt-dlp continues the .part files when the URL is downloaded again
+            print(f"Download of {url or video_id} was interrupted and will resume.")
+            ledger.record(video_id, quality, "queued")
+
+def probe_video_height(path):
+    command = ["ffprobe", "-v", "error", "-select_streams", "v:0", "-show_entries", "stream=height", "-of", "csv=p=0", path]
+    try:
+        result = subprocess.run(command, capture_output=True, text=True)
+        return int(result.stdout.strip().splitlines()[0])
+    except (FileNotFoundError, ValueError, IndexError):
+        return None
+
+def get_rendition_path(source_path, source_quality, quality):
+    root = os.path.splitext(source_path)[0]
+    suffix = f"_{source_quality}"
+    if root.endswith(suffix):
+        root = root[:-len(suffix)]
+    return f"{root}_{quality}.mp4"
+
+def derive_rendition(source_path, output_path, height):
+    source_height = probe_video_height(source_path)
+    if source_height is not None and source_height <= height:
+        # The source already fits, so the rendition is the same file under its own name
+        try:
+            os.link(source_path, output_path)
+        except OSError:
+            shutil.copyfile(source_path, output_path)
+        return True
+
+    temp_path = os.path.splitext(output_path)[0] + ".temp.mp4"
+    command = [
+        "ffmpeg", "-y", "-loglevel", "error", "-i", source_path,
+        "-vf", f"scale=-2:'min({height},ih)'",
+        "-c:v", "libx264", "-preset", "veryfast", "-crf", "23",
+        "-c:a", "copy", "-movflags", "+faststart", temp_path
+    ]
+    if subprocess.run(command).returncode != 0 or not os.path.exists(temp_path):
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        return False
+    os.replace(temp_path, output_path)
+    return True
+
+class MergeQueue:
+    # ffmpeg remux workers fed by the download workers, so a download slot is freed as soon as
+    # its streams are on disk. The queue is bounded: when merges fall behind, downloads wait.
+    # With renditions, the same workers also derive each lower quality from the merged file.
+    def __init__(self, jobs, handler, ledger=None, stats=None, renditions=(), admission=None):
+        self.jobs = max(1, jobs)
+        # Space reserved for a URL is given back once its merge is done
+        self.admission = admission
+        self.handler = handler
+        self.ledger = ledger
+        self.stats = stats or DownloadStats()
+        self.renditions = tuple(renditions)
+        self.queue = queue.Queue(maxsize=self.jobs * 2)
+        self.threads = []
+        # Called with the URL once its merge is finished, whatever the result
+        self.on_finish = None
+
+    def submit(self, url, video_id, video_quality, stream_paths, progress_callback=None, final_path=None):
+        self.queue.put((url, video_id, video_quality, stream_paths, final_path, progress_callback))
+
+    def missing_renditions(self, video_id):
+        if self.ledger is None:
+            return list(self.renditions)
+        return [quality for quality in self.renditions if not self.ledger.is_downloaded(video_id, quality)]
+
+    def derive_renditions(self, video_id, video_quality, source_path):
+        derived = True
+        for quality in self.missing_renditions(video_id):
+            output_path = get_rendition_path(source_path, video_quality, quality)
+            print(f"Deriving {quality} from {source_path}...")
+            if derive_rendition(source_path, output_path, quality_heights[quality]):
+                if self.ledger is not None:
+                    self.ledger.record(video_id, quality, "finalized", output_path, os.path.getsize(output_path))
+            else:
+                derived = False
+                if self.ledger is not None:
+                    self.ledger.record(video_id, quality, "failed")
+        return derived
+
+    def merge(self, url, video_id, video_quality, stream_paths, final_path, progress_callback):
+        status = "failed"
+        try:
+            if len(stream_paths) > 1:
+                final_path = final_path or get_final_path(stream_paths[0])
+                if progress_callback:
+                    progress_callback("merge", {})
+                merged = merge_streams(sorted(stream_paths), final_path)
+            elif final_path is None:
+                # A source finalized earlier: only its renditions are missing, the file stays where it is
+                final_path = stream_paths[0]
+                merged = True
+            else:
+                # A single pre-merged format downloaded under its stream name
+                if stream_paths[0] != final_path:
+                    os.replace(stream_paths[0], final_path)
+                merged = True
+            if self.ledger is not None:
+                if merged:
+                    self.ledger.record(video_id, video_quality, "finalized", final_path, os.path.getsize(final_path))
+                else:
+                    self.ledger.record(video_id, video_quality, "failed")
+            if merged:
+                if self.renditions and progress_callback:
+                    progress_callback("transcode", {})
+                if self.derive_renditions(video_id, video_quality, final_path):
+                    status = "done"
+            self.handler.mark_done(url, status)
+        except Exception as e:
+            print(f"Error merging streams for URL: {url}. Error message: {e}")
+        finally:
+            if self.admission is not None:
+                self.admission.release(url)
+            self.stats.finish(url, status)
+            if self.on_finish:
+                self.on_finish(url)
+
+    def run(self):
+        while True:
+            job = self.queue.get()
+            try:
+                if job is None:
+                    break
+                tracer.wrap(self.merge)(*job)
+            finally:
+                self.queue.task_done()
+
+    def join(self):
+        # Waits for every submitted merge to finish
+        self.queue.join()
+
+    def start(self):
+        self.threads = [threading.Thread(target=self.run, daemon=True) for _ in range(self.jobs)]
+        for thread in self.threads:
+            thread.start()
+
+    def stop(self):
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+def process_url(url, video_quality, format_option, download_folder, handler, ledger=None, engine=None, stats=None, stopping=None, scheduler=None, merger=None, admission=None, layout="flat", retries=None, verbose=True):
+    engine = engine or SubprocessEngine()
+    stats = stats or DownloadStats()
+    record = handler.metadata.get(canonical_url(url)) or {}
+    video_id = record.get("id") or extract_video_id(url)
+    stats.start(url)
+    status = "failed"
+    try:
+        if ledger is not None and ledger.is_downloaded(video_id, video_quality):
+            if merger is not None and merger.missing_renditions(video_id):
+                # Only the lower qualities are missing, so derive them from the file already on disk
+                source_path = ledger.get(video_id, video_quality)["path"]
+                merger.submit(url, video_id, video_quality, [source_path], make_progress_callback(url, stats, verbose=verbose), final_path=source_path)
+                status = "merging"
+                return status
+            if verbose:
+                print(f"Video {url} with quality {video_quality} is already downloaded. Removing from the list.")
+            handler.mark_done(url, "skipped")
+            status = "skipped"
+            return status
+        if retries is not None:
+            with tracer.span("throttle-wait", url):
+                dispatched = retries.wait_for_dispatch(stopping)
+            if not dispatched:
+                status = "queued"
+                return status
+        if admission is not None:
+            with tracer.span("disk-wait", url):
+                admitted = admission.acquire(url, estimate_size(record), stopping)
+            if not admitted:
+                # Left in the list, so the next run tries again once space has been freed
+                if verbose:
+                    print(f"Not enough free disk space to download {url}. Leaving it in the list.")
+                if ledger is not None:
+                    ledger.record(video_id, video_quality, "queued")
+                handler.release(url)
+                status = "queued"
+                return status
+        options = None
+        if scheduler is not None:
+            with tracer.span("bandwidth-wait", url):
+                options = scheduler.acquire(url, stopping)
+            if options is None:
+                # Shutdown started while waiting for a slot
+                status = "queued"
+                return status
+        try:
+            if ledger is not None:
+                ledger.record(video_id, video_quality, "downloading", url=url)
+            if not verbose:
+                # Also silences the engine's own output
+                options = options if options is not None else {}
+                options["quiet"] = True
+            on_progress = make_progress_callback(url, stats, verbose=verbose)
+            if ledger is not None:
+                on_progress = track_download_state(on_progress, ledger, video_id, video_quality)
+            if merger is not None:
+                paths = download_streams(url, format_option, get_output_folder(download_folder, layout), video_quality, engine, on_progress, options)
+                path = paths[-1] if paths else None
+            else:
+                path = download_video(url, format_option, get_output_folder(download_folder, layout), video_quality, engine, on_progress, options)
+        finally:
+            if scheduler is not None:
+                scheduler.release(url)
+        if merger is not None and paths and all(os.path.exists(stream_path) for stream_path in paths):
+            if retries is not None:
+                retries.success(url)
+            # The merge workers finish this URL; this worker moves on to the next download
+            merger.submit(url, video_id, video_quality, paths, on_progress, final_path=get_final_path(paths[0]))
+            status = "merging"
+            return status
+        if stopping is not None and stopping.is_set() and not (path and os.path.exists(path)):
+            # Interrupted by shutdown: leave the URL in the list so the next run resumes it
+            if ledger is not None:
+                ledger.record(video_id, video_quality, "queued")
+            status = "queued"
+            return status
+        if path and os.path.exists(path):
+            status = "done"
+            if retries is not None:
+                retries.success(url)
+        elif retries is not None:
+            kind = classify_error(*engine.last_error())
+            delay = retries.failure(url, kind)
+            if delay is not None:
+                # Stays in the list; the feeder hands it out again once the delay has passed
+                if verbose:
+                    print(f"Download of {url} failed ({kind} error). Retrying in {delay:.0f}s.")
+                if ledger is not None:
+                    ledger.record(video_id, video_quality, "queued")
+                status = "retried"
+                return status
+            if verbose:
+                print(f"Download of {url} failed ({kind} error). Giving up.")
+        if ledger is not None:
+            if status == "done":
+                ledger.record(video_id, video_quality, "finalized", path, os.path.getsize(path))
+            else:
+                ledger.record(video_id, video_quality, "failed")
+        # Record the processed URL in the download list journal
+        handler.mark_done(url, status)
+    except Exception as e:
+        if verbose:
+            print(f"Error downloading URL: {url}. Error message: {e}")
+    finally:
+        if status != "merging":
+            if admission is not None:
+                admission.release(url)
+            stats.finish(url, status)
+    return status
+
+def batch_download_videos(video_quality, handler, jobs=1, ledger=None, engine=None, stats=None, scheduler=None, merger=None, policy=None, admission=None, layout="flat", retries=None, download_folder=None):
+    download_folder = download_folder or os.path.join(os.path.expanduser("~/yt-downloader-py-data"), "downloaded-yt-video")
+    engine = engine or SubprocessEngine()
+    stats = stats or DownloadStats()
+
+    format_option = get_format_option(video_quality)
+    policy = policy or QueuePolicy()
+
+    # Bounded so the feeder never runs far ahead of the workers
+    url_queue = queue.Queue(maxsize=jobs * 2)
+    # Every URL handed to a worker in this batch, so none is queued twice
+    scheduled = set()
+    # Seen by the worker threads, so a download cut short by Ctrl+C is not recorded as failed
+    stopping = threading.Event()
+
+    def worker():
+        while True:
+            url = url_queue.get()
+            if url is None:
+                break
+            try:
+                tracer.wrap(process_url)(url, video_quality, format_option, download_folder, handler, ledger, engine, stats, stopping, scheduler=scheduler, merger=merger, admission=admission, layout=layout, retries=retries)
+            finally:
+                url_queue.task_done()
+
+    workers = [threading.Thread(target=worker, daemon=True) for _ in range(max(1, jobs))]
+    for thread in workers:
+        thread.start()
+
+    try:
+        while True:
+            with handler.lock:
+                pending = policy.order([url for url in handler.get_urls() if url not in scheduled], handler)
+                scheduled.update(pending)
+            if retries is not None:
+                # Retries whose backoff has passed go out between fresh URLs, not after all of them
+                due = retries.pop_due()
+                with handler.lock:
+                    pending += [url for url in due if url in handler.urls]
+
+            if not pending:
+                if retries is not None and retries.waiting():
+                    # Keep dispatching new URLs while failed ones wait out their backoff
+                    time.sleep(1)
+                    continue
+                # Wait for in-flight downloads and merges, then update download list in memory
+                url_queue.join()
+                if merger is not None:
+                    merger.join()
+                with handler.lock:
+                    remaining = [url for url in handler.read_new_urls() if url not in scheduled]
+                if retries is not None and retries.waiting():
+                    continue
+                if not remaining:
+                    print("Download process stopped because no valid URLs found in download-list.txt.")
+                    break
+                continue
+
+            for url in pending:
+                # Counted once it is in the queue, so a put cut short by Ctrl+C is not counted
+                url_queue.put(url)
+                policy.dispatched(url, handler)
+                stats.count("queued")
+    except BaseException:
+        # Interrupted: stop the running downloads and drop the queued ones, they stay in the list
+        stopping.set()
+        engine.cancel()
+        dropped = 0
+        while True:
+            try:
+                url_queue.get_nowait()
+            except queue.Empty:
+                break
+            url_queue.task_done()
+            dropped += 1
+        stats.count("queued", -dropped)
+        raise
+    finally:
+        for _ in workers:
+            url_queue.put(None)
+        for thread in workers:
+            thread.join()
+        if handler.completed:
+            handler.compact()
+
+async def run_daemon(video_quality, handler, jobs=1, ledger=None, engine=None, stats=None, poll_interval=None, debounce=1.0, scheduler=None, merger=None, policy=None, admission=None, layout="flat", retries=None, download_folder=None):
+    download_folder = download_folder or os.path.join(os.path.expanduser("~/yt-downloader-py-data"), "downloaded-yt-video")
+    engine = engine or SubprocessEngine()
+    stats = stats or DownloadStats()
+    format_option = get_format_option(video_quality)
+    policy = policy or QueuePolicy()
+
+    import asyncio
+
+    loop = asyncio.get_running_loop()
+    wake = asyncio.Event()
+    stop = asyncio.Event()
+    # Seen by the worker threads, so a download cut short by shutdown is not recorded as failed
+    stopping = threading.Event()
+    debounce_timer = None
+
+    def on_change():
+        # Coalesce bursts of watchdog events into one wake-up
+        nonlocal debounce_timer
+        if debounce_timer is not None:
+            debounce_timer.cancel()
+        debounce_timer = loop.call_later(debounce, wake.set)
+
+    handler.on_change = lambda: loop.call_soon_threadsafe(on_change)
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop.set)
+
+    from concurrent.futures import ThreadPoolExecutor
+
+    executor = ThreadPoolExecutor(max_workers=max(1, jobs))
+    in_flight = {}
+    # URLs handed to a worker whose run did not clear them from the list, so they are not retried in a loop
+    scheduled = set()
+
+    # How long a URL that was turned away, e.g. for lack of disk space, waits before it is tried again
+    recheck_interval = admission.interval if admission is not None else 30
+
+    def requeue(url):
+        scheduled.discard(url)
+        wake.set()
+
+    def on_done(url, status=None):
+        in_flight.pop(url, None)
+        with handler.lock:
+            listed = url in handler.urls
+        if not listed:
+            scheduled.discard(url)
+        elif status == "queued" and not stop.is_set():
+            # Still in the list but not started; a daemon has no next run, so try again later
+            loop.call_later(recheck_interval, requeue, url)
+        wake.set()
+
+    if merger is not None:
+        merger.on_finish = lambda url: loop.call_soon_threadsafe(on_done, url)
+
+    print("Daemon started. Waiting for URLs in download-list.txt...")
+    try:
+        while not stop.is_set():
+            wake.clear()
+            if retries is not None:
+                # Retries whose backoff has passed compete with the rest of the list again
+                scheduled.difference_update(retries.pop_due())
+            with handler.lock:
+                pending = policy.order([url for url in handler.read_new_urls() if url not in scheduled and url not in in_flight], handler)
+
+            # Keep at most `jobs` downloads running; the rest wait in the list file
+            for url in pending[:max(0, max(1, jobs) - len(in_flight))]:
+                scheduled.add(url)
+                policy.dispatched(url, handler)
+                stats.count("queued")
+                future = loop.run_in_executor(executor, tracer.wrap(process_url), url, video_quality, format_option, download_folder, handler, ledger, engine, stats, stopping, scheduler, merger, admission, layout, retries)
+                in_flight[url] = future
+                future.add_done_callback(lambda future, url=url: on_done(url, None if future.cancelled() or future.exception() else future.result()))
+
+            if not in_flight and handler.completed:
+                handler.compact()
+
+            timeout = poll_interval
+            if retries is not None and retries.waiting():
+                # Wake up for retries whose backoff passes while nothing else happens
+                timeout = min(timeout or 1, 1)
+            waiters = [asyncio.ensure_future(wake.wait()), asyncio.ensure_future(stop.wait())]
+            await asyncio.wait(waiters, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            for waiter in waiters:
+                waiter.cancel()
+    finally:
+        print("Stopping daemon...")
+        stopping.set()
+        engine.cancel()
+        if in_flight:
+            await asyncio.gather(*in_flight.values(), return_exceptions=True)
+        executor.shutdown(wait=True)
+        if merger is not None:
+            # Merges are local and short, so finish them instead of leaving streams behind
+            await loop.run_in_executor(None, merger.join)
+            merger.on_finish = None
+        handler.on_change = None
+        if handler.completed:
+            handler.compact()
+        stats.write(force=True)
+        print("Daemon stopped.")
+
+async def download_many(urls, quality="best", concurrency=1, data_folder=None, download_folder=None, engine=None, layout="flat", retries=None, verbose=False):
+    # Downloads `urls` and yields an event dict for every progress update and every finished URL:
+    #   {"event": "progress", "url": ..., "phase": "download", "downloaded_bytes": ..., "speed": ..., ...}
+    #   {"event": "result", "url": ..., "status": "done" | "failed" | "skipped", "path": ...}
+    # "url" is the URL as it was passed in; each of several URLs for the same video gets its own events.
+    # The ledger and metadata cache live in data_folder (default: ~/yt-downloader-py-data) and
+    # nothing is shared between calls, so one process can run several batches at a time.
+    # Leaving the loop early cancels the downloads this call started; an engine passed in may be
+    # shared with other calls. Nothing is printed unless verbose is set; the events carry it all.
+    import functools
+    from concurrent.futures import ThreadPoolExecutor
+
+    data_folder = data_folder or os.path.expanduser("~/yt-downloader-py-data")
+    download_folder = download_folder or os.path.join(data_folder, "downloaded-yt-video")
+    # The state folder need not contain the download folder, so both are created
+    os.makedirs(data_folder, exist_ok=True)
+    os.makedirs(download_folder, exist_ok=True)
+    engine = engine or SubprocessEngine()
+    retries = retries or RetryPolicy()
+    format_option = get_format_option(quality)
+
+    import asyncio
+
+    loop = asyncio.get_running_loop()
+    events = asyncio.Queue()
+    # Canonical URL -> the caller's URLs for that video
+    inputs = {}
+    for url in urls:
+        inputs.setdefault(canonical_url(url), []).append(url)
+    handler = UrlListHandler(inputs)
+    ledger = DownloadLedger(os.path.join(data_folder, "download-ledger.sqlite3"))
+    cache = MetadataCache(os.path.join(data_folder, "metadata-cache.sqlite3"))
+    stats = DownloadStats()
+
+    def on_progress(url, phase, progress):
+        for original in inputs.get(url, [url]):
+            loop.call_soon_threadsafe(events.put_nowait, dict(progress, event="progress", url=original, phase=phase))
+
+    def on_done(url, status):
+        record = handler.metadata.get(url) or {}
+        entry = ledger.get(record.get("id") or extract_video_id(url), quality)
+        path = entry["path"] if entry and status in ("done", "skipped") else None
+        for original in inputs.get(url, [url]):
+            loop.call_soon_threadsafe(events.put_nowait, {"event": "result", "url": original, "status": status, "path": path})
+
+    stats.on_progress = on_progress
+    handler.on_done = on_done
+    executor = ThreadPoolExecutor(max_workers=max(1, concurrency))
+    stopping = threading.Event()
+    # Future of each running process_url call and its URL
+    in_flight = {}
+    try:
+        valid_urls = await loop.run_in_executor(executor, functools.partial(validate_download_list, handler, quality, concurrency, ledger, cache, engine, stats, layout=layout, retries=retries, download_folder=download_folder, verbose=verbose))
+        pending = collections.deque(valid_urls)
+        valid_urls = set(valid_urls)
+        for url in handler.get_urls():
+            if url not in valid_urls:
+                # Rejected by the metadata lookup
+                handler.mark_done(url, "failed")
+
+        while pending or in_flight or retries.waiting() or not events.empty():
+            pending.extend(url for url in retries.pop_due() if url in handler.urls)
+            while pending and len(in_flight) < max(1, concurrency):
+                url = pending.popleft()
+                stats.count("queued")
+                future = loop.run_in_executor(executor, functools.partial(process_url, url, quality, format_option, download_folder, handler, ledger, engine, stats, stopping, layout=layout, retries=retries, verbose=verbose))
+                in_flight[future] = url
+
+            getter = asyncio.ensure_future(events.get())
+            # Retries due later are picked up by polling, as nothing else wakes the loop for them
+            timeout = 1 if retries.waiting() else None
+            done, _ = await asyncio.wait([*in_flight, getter], timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            for future in done:
+                url = in_flight.pop(future, None)
+                if url is not None and future.result() == "failed" and url in handler.urls:
+                    # process_url gave up on an unexpected error without a result of its own
+                    handler.mark_done(url, "failed")
+            if getter.done():
+                yield getter.result()
+            else:
+                getter.cancel()
+    finally:
+        stopping.set()
+        if in_flight:
+            # Left early: stop only what this call is running
+            engine.cancel(set(in_flight.values()))
+            await asyncio.gather(*in_flight, return_exceptions=True)
+        executor.shutdown(wait=True)
+        ledger.close()
+        cache.close()
 
 def usage():
     usage_text = """
@@ -192,7 +2477,59 @@ Usage: python3 yt-downloader-py.py [options]
 
 Options:
   -h, --help            Show this help message and exit
-  -q, --quality         Video quality to download (choices: best, 1080p, 720p, 480p)
+  --setup               Install missing dependencies (watchdog, requests, ffmpeg, yt-dlp) and exit
+  --daemon              Keep running and download URLs as soon as they are added to the list.
+                        Stops cleanly on SIGTERM or Ctrl+C; interrupted downloads resume on the next run
+  -q, --quality         Video quality to download (choices: best, 1080p, 720p, 480p). Several can be given:
+                        the highest is downloaded and the others are derived from it with ffmpeg
+  -j, --jobs            Number of videos to download, and metadata batches to resolve, at the same time (default: 1)
+  --cache-ttl           Hours before cached video metadata is fetched again (default: 168)
+  --cache-size          Maximum number of videos kept in the metadata cache (default: 10000)
+  --engine              How yt-dlp is run (choices: subprocess, api; default: subprocess)
+                        "api" drives the yt_dlp Python package in one long-lived process
+  --adaptive            Start with one download and add more while throughput keeps growing, up to --jobs
+  --max-rate            Global download rate cap in bytes per second, e.g. 500K, 2M (default: unlimited).
+                        With the api engine it is re-split between running downloads as they come and go;
+                        with yt-dlp as a command each download gets its share of --jobs, set when it starts
+  --bandwidth-window    Rate cap for a time of day as HH:MM-HH:MM=RATE, e.g. 08:00-18:00=1M; can be repeated
+  --max-per-host        Maximum number of downloads from the same host at a time (default: unlimited)
+  --max-fragments       Fragment downloads shared by all running videos (default: 4)
+  --order               Order of downloads among URLs with the same priority (choices: fifo, shortest, fair;
+                        default: fifo). "shortest" starts the smallest videos first, "fair" takes turns
+                        between channels by bytes downloaded. Add "priority=N" after a URL in the list
+                        to download it before URLs with a lower number (default: 0)
+  --layout              Folder layout inside downloaded-yt-video (choices: flat, channel, id-prefix; default: flat).
+                        "channel" puts each channel in its own folder, "id-prefix" shards by the first two
+                        characters of the video ID
+  --min-free            Free disk space to keep (default: 1G). A download starts only if twice its estimated
+                        size fits on top of this and of the downloads already running
+  --where               Print the downloaded files of a video ID or URL and exit
+  --retries             Times a download that failed for a temporary reason is tried again (default: 3).
+                        Videos that are private, removed or unavailable are not retried
+  --retry-delay         Seconds of backoff before the first retry, doubled for each further attempt and
+                        randomized so retries are spread out (default: 30). When the site answers with
+                        rate limiting (HTTP 429, "confirm you're not a bot"), new downloads pause for a
+                        cooldown that doubles while the throttling lasts
+  --merge-jobs          Merge video and audio in this many separate ffmpeg workers, so the next download
+                        starts while the previous one is merged (default: 0, yt-dlp merges in the download slot;
+                        1 when several qualities are requested)
+  --queue               Shared SQLite queue file used instead of download-list.txt, so several machines can work
+                        through one list. Each URL is leased to one worker at a time and handed to another if
+                        that worker stops renewing its lease
+  --enqueue             Add the URLs in download-list.txt to the --queue file and exit
+  --lease-time          Seconds a worker holds a URL from --queue before other workers may take it (default: 300)
+  --worker-id           Name recorded in the --queue file for this worker (default: hostname-pid)
+  --manifest            NDJSON file that gets a record with size, duration and SHA-256 for every finished file
+                        (default: ~/yt-downloader-py-data/manifest.ndjson)
+  --verify              Check every file in the manifest against its size and SHA-256, using --jobs workers,
+                        report missing, truncated and corrupt files, and exit
+  --profile             Folder to write a profile of this run to: trace.json (Chrome trace events with a span
+                        for every phase of every URL, for chrome://tracing or ui.perfetto.dev) and summary.txt
+                        (time per phase)
+  --profile-python      With --profile, also run the Python side under cProfile and write profile.pstats
+  --status-file         JSON file with live progress and counters (default: ~/yt-downloader-py-data/status.json)
+  --metrics-file        Prometheus textfile with the same counters and phase latency histograms
+                        (default: ~/yt-downloader-py-data/metrics.prom)
   
 Examples:
   1. Download with default quality (best available):
@@ -201,12 +2538,26 @@ Examples:
   2. Download with specified quality:
      python3 yt-downloader-py.py --quality 720p
      python3 yt-downloader-py.py -q 1080p
+
+  3. Download each video once and derive 720p and 480p copies from it:
+     python3 yt-downloader-py.py -q best 720p 480p
+
+  4. Download four videos at a time:
+     python3 yt-downloader-py.py -q 720p --jobs 4
+
+  5. Run in the background and download new URLs as they are added:
+     python3 yt-downloader-py.py --daemon --jobs 2
      
 Description:
   This script downloads YouTube videos based on a list of URLs provided in the ~/yt-downloader-py-data/download-list.txt file.
   The videos will be downloaded to the ~/yt-downloader-py-data/downloaded-yt-video directory.
-  If the required dependencies (yt-dlp and ffmpeg) are not installed, the script will install them automatically.
+  Run with --setup once to install the required dependencies (yt-dlp, ffmpeg, watchdog and requests).
+  Normal runs only check that they are present; the version check is cached in
+  ~/yt-downloader-py-data/dependency-cache.json and repeated only when a binary's path or mtime changes.
   The downloaded videos will be saved in MP4 format with the specified quality.
+  Finished downloads are recorded by video ID and quality in ~/yt-downloader-py-data/download-ledger.sqlite3,
+  so URLs that were already downloaded are skipped without looking them up online.
+  Video titles and formats are cached by video ID in ~/yt-downloader-py-data/metadata-cache.sqlite3.
 
 Note:
   Ensure that the URLs in ~/yt-downloader-py-data/download-list.txt are valid YouTube video URLs.
@@ -215,7 +2566,35 @@ Note:
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Download YouTube videos with specified quality.", add_help=False)
-    parser.add_argument("-q", "--quality", choices=["best", "1080p", "720p", "480p"], default="best", help="Video quality to download")
+    parser.add_argument("-q", "--quality", nargs="+", choices=list(quality_order), default=["best"], help="Video qualities to download")
+    parser.add_argument("-j", "--jobs", type=int, default=1, help="Number of videos to download at the same time")
+    parser.add_argument("--cache-ttl", type=float, default=168, help="Hours before cached video metadata is fetched again")
+    parser.add_argument("--cache-size", type=int, default=10000, help="Maximum number of videos kept in the metadata cache")
+    parser.add_argument("--engine", choices=["subprocess", "api"], default="subprocess", help="How yt-dlp is run")
+    parser.add_argument("--adaptive", action="store_true", help="Adjust the number of concurrent downloads to measured throughput")
+    parser.add_argument("--max-rate", help="Global download rate cap in bytes per second, e.g. 500K, 2M")
+    parser.add_argument("--bandwidth-window", action="append", default=[], help="Rate cap for a time of day as HH:MM-HH:MM=RATE")
+    parser.add_argument("--max-per-host", type=int, help="Maximum number of downloads from the same host at a time")
+    parser.add_argument("--max-fragments", type=int, default=4, help="Fragment downloads shared by all running videos")
+    parser.add_argument("--order", choices=QueuePolicy.policies, default="fifo", help="Order in which queued URLs are downloaded")
+    parser.add_argument("--layout", choices=list(layouts), default="flat", help="Folder layout inside downloaded-yt-video")
+    parser.add_argument("--min-free", default="1G", help="Free disk space to keep, e.g. 500M, 10G; downloads that would cut into it wait")
+    parser.add_argument("--where", help="Print the downloaded files of a video ID or URL and exit")
+    parser.add_argument("--retries", type=int, default=3, help="Times a failed download is tried again before it is given up")
+    parser.add_argument("--retry-delay", type=float, default=30, help="Seconds of backoff before the first retry; doubles with each attempt")
+    parser.add_argument("--merge-jobs", type=int, default=0, help="Number of separate ffmpeg workers that merge downloaded streams")
+    parser.add_argument("--status-file", default=os.path.expanduser("~/yt-downloader-py-data/status.json"), help="JSON file with live progress and counters")
+    parser.add_argument("--metrics-file", default=os.path.expanduser("~/yt-downloader-py-data/metrics.prom"), help="Prometheus textfile with counters and phase latency histograms")
+    parser.add_argument("--queue", help="Shared SQLite queue file used instead of download-list.txt, e.g. on an NFS mount")
+    parser.add_argument("--enqueue", action="store_true", help="Add the URLs in download-list.txt to the --queue file and exit")
+    parser.add_argument("--lease-time", type=float, default=300, help="Seconds a worker holds a URL from --queue before others may take it")
+    parser.add_argument("--worker-id", help="Name recorded in --queue for this worker (default: hostname-pid)")
+    parser.add_argument("--manifest", default=os.path.expanduser("~/yt-downloader-py-data/manifest.ndjson"), help="NDJSON file with a SHA-256 record of every finished file")
+    parser.add_argument("--verify", action="store_true", help="Check every file in the manifest against its size and SHA-256 and exit")
+    parser.add_argument("--profile", help="Folder to write a Chrome trace and a per-phase time summary of this run to")
+    parser.add_argument("--profile-python", action="store_true", help="With --profile, also run every worker under cProfile")
+    parser.add_argument("--setup", action="store_true", help="Install missing dependencies and exit")
+    parser.add_argument("--daemon", action="store_true", help="Keep running and download URLs as soon as they are added")
     parser.add_argument("-h", "--help", action="store_true", help="Show this help message and exit")
     args = parser.parse_args()
 
@@ -223,24 +2602,106 @@ if __name__ == "__main__":
         usage()
         exit()
 
-    check_dependency("ffmpeg", ["sudo", "apt", "install", "-y", "ffmpeg"], version_arg="-version")
-    if check_yt_dlp():
-        validate_download_folder()
-        
-        data_folder = os.path.expanduser("~/yt-downloader-py-data")
-        download_list_path = os.path.join(data_folder, "download-list.txt")
+    data_folder = os.path.expanduser("~/yt-downloader-py-data")
+    validate_download_folder()
+
+    if args.setup:
+        if setup_dependencies(data_folder):
+            print("Setup is complete.")
+        exit()
+
+    download_list_path = os.path.join(data_folder, "download-list.txt")
+    lease_queue = SqliteLeaseQueue(args.queue) if args.queue else None
+    if args.enqueue:
+        if lease_queue is None:
+            print("--enqueue needs --queue.")
+            sys.exit(1)
+        urls = DownloadListHandler(download_list_path).get_urls()
+        print(f"Added {lease_queue.add(urls)} of {len(urls)} URLs to {args.queue}.")
+        lease_queue.close()
+        exit()
+
+    if args.verify:
+        if not os.path.exists(args.manifest):
+            print(f"No manifest found at {args.manifest}.")
+            sys.exit(1)
+        sys.exit(0 if verify_manifest(args.manifest, args.jobs) else 1)
+
+    if args.where:
+        ledger = DownloadLedger(os.path.join(data_folder, "download-ledger.sqlite3"))
+        paths = ledger.find(extract_video_id(args.where) or args.where)
+        ledger.close()
+        for quality, path in paths.items():
+            print(f"{quality}\t{path}")
+        sys.exit(0 if paths else 1)
+
+    engine = get_engine(args.engine)
+    missing = find_missing_dependencies(data_folder, engine)
+    if missing:
+        print(f"Missing dependencies: {', '.join(missing)}. Run with --setup to install them.")
+        sys.exit(1)
+
+    if args.profile:
+        tracer.enable(args.profile_python)
+
+    if lease_queue is not None:
+        handler = LeasedQueueHandler(lease_queue, args.worker_id, args.jobs * 2, args.lease_time)
+        handler.start()
+        observer = None
+    else:
         handler = DownloadListHandler(download_list_path)
         observer = monitor_file(download_list_path, handler)
+    cache = MetadataCache(os.path.join(data_folder, "metadata-cache.sqlite3"), args.cache_ttl * 3600, args.cache_size)
+    manifest = Manifest(args.manifest, max(2, args.merge_jobs), cache)
+    ledger = DownloadLedger(os.path.join(data_folder, "download-ledger.sqlite3"), manifest)
+    stats = DownloadStats(args.status_file, args.metrics_file)
+    recover_downloads(ledger, handler)
+    scheduler = None
+    if args.adaptive or args.max_rate or args.bandwidth_window or args.max_per_host:
+        windows = [parse_bandwidth_window(window) for window in args.bandwidth_window]
+        scheduler = BandwidthScheduler(stats, args.jobs, parse_rate(args.max_rate), args.max_per_host, windows, args.max_fragments, args.adaptive, live=engine.name == "api")
+        scheduler.start()
+    # The highest requested quality is downloaded; the others are derived from it locally
+    qualities = sorted(set(args.quality), key=quality_order.index)
+    video_quality, renditions = qualities[0], qualities[1:]
+    policy = QueuePolicy(args.order)
+    admission = DiskAdmission(os.path.join(data_folder, "downloaded-yt-video"), parse_rate(args.min_free))
+    retries = RetryPolicy(args.retries, args.retry_delay)
+    merger = None
+    if args.merge_jobs > 0 or renditions:
+        merger = MergeQueue(max(1, args.merge_jobs), handler, ledger, stats, renditions, admission)
+        merger.start()
 
-        try:
-            urls_to_download = validate_download_list(handler, args.quality)
-            if urls_to_download:
-                batch_download_videos(args.quality, handler)
-            else:
-                print("Download process stopped because no valid URLs found in download-list.txt.")
-                observer.stop()
-                observer.join()
-                sys.exit(0)
-        except KeyboardInterrupt:
+    try:
+        urls_to_download = tracer.wrap(validate_download_list)(handler, video_quality, args.jobs, ledger, cache, engine, stats, renditions, args.layout, retries)
+        if args.daemon:
+            # Without watchdog, poll the list instead of waiting for file events
+            poll_interval = 30 if observer is None else None
+            if lease_queue is not None:
+                poll_interval = 10
+            # Imported here because it pulls in concurrent.futures and logging, which a batch run never needs
+            import asyncio
+            asyncio.run(run_daemon(video_quality, handler, args.jobs, ledger, engine, stats, poll_interval, scheduler=scheduler, merger=merger, policy=policy, admission=admission, layout=args.layout, retries=retries))
+        elif urls_to_download:
+            tracer.wrap(batch_download_videos)(video_quality, handler, args.jobs, ledger, engine, stats, scheduler, merger, policy, admission, args.layout, retries)
+        else:
+            print("Download process stopped because no valid URLs found in download-list.txt.")
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if scheduler is not None:
+            scheduler.stop()
+        if merger is not None:
+            merger.stop()
+        if observer is not None:
             observer.stop()
             observer.join()
+        if lease_queue is not None:
+            handler.stop()
+            lease_queue.close()
+        # Finish the checksums still being computed before the cache they read durations from is closed
+        manifest.close()
+        ledger.close()
+        cache.close()
+        if args.profile:
+            tracer.write(args.profile)